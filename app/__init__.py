@@ -3,6 +3,7 @@ from flask import Flask
 from config import Config          # <- import the Config class directly
 from .db import db                 # <- your SQLAlchemy instance
 from .routes import bp as main_bp  # <- your blueprint
+from . import events, live
 
 def create_app():
     app = Flask(__name__)
@@ -13,6 +14,12 @@ def create_app():
     # Initialize database extension
     db.init_app(app)
 
+    # Write-behind buffer for click/report tracking
+    events.init_app(app)
+
+    # Live progress/activity streams (Server-Sent Events)
+    live.init_app(app)
+
     # Register main blueprint (routes)
     app.register_blueprint(main_bp)
 
@@ -0,0 +1,201 @@
+import numpy as np
+from flask import current_app
+from sqlalchemy import or_, select, tuple_
+from .db import db
+from . import stats
+from .models import Campaign, CampaignRecipient, Department, Recipient
+
+# --- Campaign analytics --- #
+# Loads the delivered/clicked/reported times of the selected campaigns' rows
+# in campaign_recipients into NumPy columns (a keyset page at a time) and
+# computes every metric with array operations:
+# time-to-click/report percentiles, the delivered -> clicked -> reported
+# funnel, and per-department rates with 95% Wilson confidence intervals.
+
+PERCENTILES = (50, 90, 99)
+
+# Upper edges (minutes) of the time-to-click histogram bins; the last bin is open
+HISTOGRAM_EDGES = (5, 15, 30, 60, 120, 240, 480, 1440, 4320)
+
+# Rows fetched per query while loading
+LOAD_BATCH = 50_000
+
+# z for a two-sided 95% interval
+Z_95 = 1.959964
+
+
+def _epoch_seconds(values):
+    ts = np.array([t.replace(tzinfo=None) if t else None for t in values], dtype="datetime64[us]")
+    return np.where(np.isnat(ts), np.nan, ts.astype("int64") / 1e6)
+
+
+def _load(campaign_id=None, department_id=None, start=None, end=None):
+    """
+    One row per matching (campaign, recipient) from campaign_recipients:
+    campaign ids, department ids (0 = none) and an (n, 3) array of
+    delivered/clicked/reported epoch seconds (NaN = didn't happen).
+    start/end select campaigns created in [start, end).
+    """
+    cr = CampaignRecipient
+    query = (
+        select(cr.campaign_id, cr.recipient_id, Recipient.department_id, cr.delivered_at, cr.clicked_at, cr.reported_at)
+        .join(Recipient, Recipient.id == cr.recipient_id)
+        .where(or_(cr.delivered_at.is_not(None), cr.clicked_at.is_not(None), cr.reported_at.is_not(None)))
+    )
+    if campaign_id:
+        query = query.where(cr.campaign_id == campaign_id)
+    if department_id:
+        query = query.where(Recipient.department_id == department_id)
+    if start is not None or end is not None:
+        query = query.join(Campaign, Campaign.id == cr.campaign_id)
+        if start is not None:
+            query = query.where(Campaign.created_at >= start)
+        if end is not None:
+            query = query.where(Campaign.created_at < end)
+
+    parts = []
+    after = (0, 0)
+    while True:
+        rows = db.session.execute(
+            query.where(tuple_(cr.campaign_id, cr.recipient_id) > after)
+            .order_by(cr.campaign_id, cr.recipient_id)
+            .limit(LOAD_BATCH)
+        ).all()
+        if not rows:
+            break
+        after = (rows[-1][0], rows[-1][1])
+        cids, _, depts, delivered, clicked, reported = zip(*rows)
+        parts.append((
+            np.array(cids, dtype=np.int64),
+            np.array([d or 0 for d in depts], dtype=np.int64),
+            np.stack([_epoch_seconds(delivered), _epoch_seconds(clicked), _epoch_seconds(reported)], axis=1),
+        ))
+
+    if not parts:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty((0, 3))
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+def _percentiles(values):
+    if values.size == 0:
+        return {f"p{p}": None for p in PERCENTILES}
+    return {f"p{p}": float(v) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+
+
+def _wilson(successes, totals):
+    """95% Wilson score intervals for arrays of counts; (low, high) arrays, NaN where total is 0."""
+    n = totals.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = successes / n
+        denom = 1 + Z_95 ** 2 / n
+        centre = (p + Z_95 ** 2 / (2 * n)) / denom
+        half = Z_95 * np.sqrt(p * (1 - p) / n + Z_95 ** 2 / (4 * n ** 2)) / denom
+    return centre - half, centre + half
+
+
+def _rate(part, whole):
+    return part / whole if whole else None
+
+
+def _grouped(keys, delivered, clicked, reported):
+    """Counts and click/report rates (with CIs) per distinct key."""
+    groups, inverse = np.unique(keys, return_inverse=True)
+    size = len(groups)
+    n_delivered = np.bincount(inverse, weights=delivered, minlength=size)
+    n_clicked = np.bincount(inverse, weights=clicked, minlength=size)
+    n_reported = np.bincount(inverse, weights=reported, minlength=size)
+    click_low, click_high = _wilson(n_clicked, n_delivered)
+    report_low, report_high = _wilson(n_reported, n_delivered)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        click_rate = n_clicked / n_delivered
+        report_rate = n_reported / n_delivered
+
+    def num(x):
+        return None if np.isnan(x) else float(x)
+
+    return [
+        {
+            "id": int(groups[i]),
+            "delivered": int(n_delivered[i]),
+            "clicked": int(n_clicked[i]),
+            "reported": int(n_reported[i]),
+            "click_rate": num(click_rate[i]),
+            "click_rate_ci": [num(click_low[i]), num(click_high[i])],
+            "report_rate": num(report_rate[i]),
+            "report_rate_ci": [num(report_low[i]), num(report_high[i])],
+        }
+        for i in range(size)
+    ]
+
+
+def compute(campaign_id=None, department_id=None, start=None, end=None):
+    """
+    Analytics for the matching campaigns/recipients, as a JSON-ready dict:
+    time_to_click / time_to_report (seconds from delivery: count and
+    p50/p90/p99, plus a histogram in minutes), funnel, departments and
+    campaigns (counts and rates with 95% confidence intervals).
+    Clicks and reports only count for recipients with a delivery time.
+    """
+    pair_cids, pair_depts, times = _load(campaign_id, department_id, start, end)
+    delivered_at, clicked_at, reported_at = times[:, 0], times[:, 1], times[:, 2]
+
+    delivered = ~np.isnan(delivered_at)
+    clicked = delivered & ~np.isnan(clicked_at)
+    reported = delivered & ~np.isnan(reported_at)
+    clicked_then_reported = clicked & reported
+
+    to_click = clicked_at[clicked] - delivered_at[clicked]
+    to_report = reported_at[reported] - delivered_at[reported]
+    to_click = to_click[to_click >= 0]
+    to_report = to_report[to_report >= 0]
+
+    edges = np.array((0, *HISTOGRAM_EDGES, np.inf))
+    histogram = np.histogram(to_click / 60, bins=edges)[0] if to_click.size else np.zeros(len(edges) - 1)
+
+    n_delivered = int(delivered.sum())
+    n_clicked = int(clicked.sum())
+    n_reported = int(reported.sum())
+
+    departments = _grouped(pair_depts, delivered, clicked, reported)
+    names = dict(db.session.execute(
+        select(Department.id, Department.name).where(Department.id.in_([d["id"] for d in departments]))
+    ).all())
+    for d in departments:
+        d["name"] = names.get(d["id"], "No department")
+
+    campaigns = _grouped(pair_cids, delivered, clicked, reported)
+    names = dict(db.session.execute(
+        select(Campaign.id, Campaign.name).where(Campaign.id.in_([c["id"] for c in campaigns]))
+    ).all())
+    for c in campaigns:
+        c["name"] = names.get(c["id"])
+
+    return {
+        "time_to_click": {"count": int(to_click.size), **_percentiles(to_click)},
+        "time_to_report": {"count": int(to_report.size), **_percentiles(to_report)},
+        "time_to_click_histogram": {
+            "edges_minutes": list(HISTOGRAM_EDGES),
+            "counts": [int(n) for n in histogram],
+        },
+        "funnel": {
+            "delivered": n_delivered,
+            "clicked": n_clicked,
+            "reported": n_reported,
+            "clicked_and_reported": int(clicked_then_reported.sum()),
+            "click_rate": _rate(n_clicked, n_delivered),
+            "report_rate": _rate(n_reported, n_delivered),
+            "report_rate_after_click": _rate(int(clicked_then_reported.sum()), n_clicked),
+        },
+        "departments": sorted(departments, key=lambda d: d["name"]),
+        "campaigns": campaigns,
+    }
+
+
+def cached(campaign_id=None, department_id=None, start=None, end=None):
+    """compute(), kept in the dashboard cache (cleared whenever new events are committed)."""
+    stats.dashboard_cache.ttl = current_app.config.get("DASHBOARD_CACHE_TTL", 30)
+    return stats.dashboard_cache.get(
+        ("analytics", campaign_id, department_id, start, end),
+        lambda: compute(campaign_id, department_id, start, end),
+    )
@@ -0,0 +1,112 @@
+from sqlalchemy import and_, delete, or_, update
+from . import roster
+from .db import db
+from .models import Department, Recipient
+
+# --- Bulk recipient operations --- #
+# Re-orgs move, detach or delete thousands of recipients at once. Each
+# operation here is a single UPDATE/DELETE over a selection of recipients
+# (by id, by email and/or by current department) instead of one ORM object
+# per request, and returns how many rows it touched.
+
+ACTIONS = ("move", "detach", "delete")
+
+# Longest id/email list put into a single IN (...); bigger lists are split
+# into several statements (still one per 1000 recipients, not one each)
+IN_LIST_SIZE = 1000
+
+
+def _slices(values):
+    values = list(values)
+    for start in range(0, len(values), IN_LIST_SIZE):
+        yield values[start:start + IN_LIST_SIZE]
+
+
+def _conditions(recipient_ids=None, emails=None, department_id=None, all_in_department=False):
+    """
+    WHERE clauses selecting the recipients, one per statement to run.
+
+    recipient_ids and emails are combined with OR; department_id narrows
+    the selection. An empty selection matches nothing: the whole of
+    department_id is only selected with all_in_department=True.
+    """
+    in_department = [Recipient.department_id == department_id] if department_id is not None else []
+    ids = sorted({int(i) for i in recipient_ids or ()})
+    addresses = {e.strip().lower() for e in emails or () if e and e.strip()}
+
+    if all_in_department:
+        if department_id is None:
+            raise ValueError("all_in_department needs a department_id")
+        if ids or addresses:
+            raise ValueError("Pick either recipients or a whole department, not both")
+        return [and_(*in_department)]
+    if not ids and not addresses:
+        return []
+
+    conditions = [and_(Recipient.id.in_(chunk), *in_department) for chunk in _slices(ids)]
+    conditions += [and_(Recipient.email_lower.in_(chunk), *in_department) for chunk in _slices(sorted(addresses))]
+    return conditions
+
+
+def _run(statement, conditions):
+    if not conditions:
+        return 0
+    affected = 0
+    for condition in conditions:
+        affected += db.session.execute(
+            statement.where(condition).execution_options(synchronize_session=False)
+        ).rowcount
+    # Department breakdowns on the dashboard follow recipients' departments
+    db.session.info["stats_changed"] = True
+    roster.mark_changed()
+    return affected
+
+
+def move_recipients(to_department_id, recipient_ids=None, emails=None, department_id=None, all_in_department=False):
+    """Put the selected recipients in to_department_id. Returns the number moved."""
+    if db.session.get(Department, to_department_id) is None:
+        raise ValueError(f"No department with id {to_department_id}")
+    conditions = _conditions(recipient_ids, emails, department_id, all_in_department)
+    # Recipients already there aren't counted as moved
+    conditions = [
+        and_(c, or_(Recipient.department_id.is_(None), Recipient.department_id != to_department_id))
+        for c in conditions
+    ]
+    return _run(update(Recipient).values(department_id=to_department_id), conditions)
+
+
+def detach_recipients(recipient_ids=None, emails=None, department_id=None, all_in_department=False):
+    """Take the selected recipients out of their department. Returns the number detached."""
+    conditions = [and_(c, Recipient.department_id.isnot(None))
+                  for c in _conditions(recipient_ids, emails, department_id, all_in_department)]
+    return _run(update(Recipient).values(department_id=None), conditions)
+
+
+def delete_recipients(recipient_ids=None, emails=None, department_id=None, all_in_department=False):
+    """
+    Delete the selected recipients. Their events and campaign_recipients
+    rows go with them (ON DELETE CASCADE). Returns the number deleted.
+    """
+    return _run(delete(Recipient), _conditions(recipient_ids, emails, department_id, all_in_department))
+
+
+def apply(action, **selection):
+    """Dispatch one of ACTIONS; `to_department_id` is only used (and required) by "move"."""
+    to_department_id = selection.pop("to_department_id", None)
+    if action == "move":
+        if to_department_id is None:
+            raise ValueError("A target department is required to move recipients")
+        return move_recipients(to_department_id, **selection)
+    if action == "detach":
+        return detach_recipients(**selection)
+    if action == "delete":
+        return delete_recipients(**selection)
+    raise ValueError(f"Unknown action {action!r}; expected one of {', '.join(ACTIONS)}")
+
+
+def delete_department(department_id):
+    """Detach the department's recipients and delete it. Returns the number detached."""
+    detached = detach_recipients(department_id=department_id, all_in_department=True)
+    db.session.execute(delete(Department).where(Department.id == department_id))
+    roster.mark_changed()
+    return detached
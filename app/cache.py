@@ -0,0 +1,45 @@
+import threading
+import time
+
+# --- Small in-process caches --- #
+
+
+class TTLCache:
+    """
+    Thread-safe key -> value cache whose entries expire after `ttl` seconds
+    or when invalidate() is called, whichever comes first.
+
+    A value computed while an invalidation happened is returned to its caller
+    but not stored, so a slow computation can't put pre-invalidation data
+    back into the cache.
+    """
+
+    def __init__(self, ttl: float = 30.0, max_entries: int = 64):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}  # key -> (expires_at, value)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """The cached value for `key`, or compute() (cached for next time)."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+            generation = self._generation
+
+        value = compute()
+
+        with self._lock:
+            if generation == self._generation and self.ttl > 0:
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
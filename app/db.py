@@ -1,3 +1,38 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, insert
 
 db = SQLAlchemy()
+
+
+def insert_ignore(table):
+    """
+    INSERT that silently skips rows which would violate a unique key,
+    spelled the way the current database wants it.
+    """
+    dialect = db.engine.dialect.name
+    if dialect in ("mysql", "mariadb"):
+        return insert(table).prefix_with("IGNORE")
+    if dialect == "sqlite":
+        return insert(table).prefix_with("OR IGNORE")
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        return pg_insert(table).on_conflict_do_nothing()
+    raise NotImplementedError(f"insert_ignore: unsupported database {dialect!r}")
+
+
+def truncate_datetime(column, granularity):
+    """
+    SQL expression for the start of the 'day' or 'hour' containing `column`,
+    spelled the way the current database wants it. The result compares equal
+    to a Python datetime bound for the same instant.
+    """
+    dialect = db.engine.dialect.name
+    hour = "%H" if granularity == "hour" else "00"
+    if dialect in ("mysql", "mariadb"):
+        return func.date_format(column, f"%Y-%m-%d {hour}:00:00")
+    if dialect == "sqlite":
+        # Same text format SQLAlchemy stores SQLite datetimes in
+        return func.strftime(f"%Y-%m-%d {hour}:00:00.000000", column)
+    if dialect == "postgresql":
+        return func.date_trunc(granularity, column)
+    raise NotImplementedError(f"truncate_datetime: unsupported database {dialect!r}")
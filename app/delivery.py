@@ -0,0 +1,91 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .emailer import ROUTES, route_for, send_prepared
+
+# --- Concurrent delivery engine --- #
+# Each provider route (see emailer.route_for) gets its own worker threads and
+# its own messages-per-second limit, so Mailtrap and Gmail traffic go out in
+# parallel without one provider's throttling slowing down the other.
+
+
+class RateLimiter:
+    """
+    Spaces calls evenly so no more than `rate` happen per second.
+
+    rate <= 0 disables the limit. Thread-safe: each caller reserves the next
+    free slot, then sleeps (outside the lock) until that slot comes up.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class DeliveryEngine:
+    """
+    Sends emails on per-route thread pools, honouring per-route rate limits.
+
+    `limits` maps route name -> (concurrency, messages_per_second).
+    submit_message() returns a Future that resolves when the SMTP send
+    finishes (or raises whatever send_prepared raised).
+    """
+
+    def __init__(self, limits: dict):
+        self._executors = {}
+        self._limiters = {}
+        workers = 0
+        for route in ROUTES:
+            concurrency, rate = limits.get(route, (1, 0))
+            concurrency = max(int(concurrency), 1)
+            workers += concurrency
+            self._executors[route] = ThreadPoolExecutor(
+                max_workers=concurrency,
+                thread_name_prefix=f"clicksafe-{route}",
+            )
+            self._limiters[route] = RateLimiter(rate)
+
+        # How many sends a caller should keep queued at once to keep every
+        # route busy without buffering a whole campaign in memory
+        self.max_in_flight = 2 * workers
+
+    def _send_message(self, route, to_addr, message):
+        self._limiters[route].wait()
+        send_prepared(to_addr, message)
+
+    def submit_message(self, to_addr: str, message: str):
+        """Send a message already built with emailer.PreparedMessage on its route's pool."""
+        route = route_for(to_addr)
+        return self._executors[route].submit(self._send_message, route, to_addr, message)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(app) -> DeliveryEngine:
+    """
+    Process-wide engine built from the app config, so concurrent campaigns
+    share (and together respect) each provider's limits.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            cfg = app.config
+            _engine = DeliveryEngine({
+                "mailtrap": (cfg.get("MAILTRAP_CONCURRENCY", 4), cfg.get("MAILTRAP_RATE_LIMIT", 0)),
+                "gmail": (cfg.get("GMAIL_CONCURRENCY", 4), cfg.get("GMAIL_RATE_LIMIT", 0)),
+            })
+        return _engine
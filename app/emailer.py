@@ -1,5 +1,9 @@
 import os
+import atexit
+import queue
 import smtplib
+import threading
+from email import base64mime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from dotenv import load_dotenv
@@ -22,11 +26,36 @@ GMAIL_PASSWORD = os.getenv("GMAIL_PASSWORD")
 GMAIL_FROM_ADDR = os.getenv("GMAIL_FROM_ADDR", GMAIL_USERNAME or "")
 GMAIL_FROM_NAME = os.getenv("GMAIL_FROM_NAME", "ClickSafe Alerts")
 
-def _send_via_smtp(host, port, username, password,
-                   from_addr, from_name,
-                   to_addr, subject, html_body, text_body: str | None = None):
+# --- Connection pool: reuse authenticated SMTP sessions --- #
+# Max open connections per provider, and how many messages one connection
+# sends before it is closed and replaced with a fresh one.
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+SMTP_POOL_MAX_MESSAGES = int(os.getenv("SMTP_POOL_MAX_MESSAGES", "100"))
+
+# Provider settings, keyed by route name (see route_for)
+ROUTES = {
+    "mailtrap": dict(
+        host=MAILTRAP_HOST,
+        port=MAILTRAP_PORT,
+        username=MAILTRAP_USERNAME,
+        password=MAILTRAP_PASSWORD,
+        from_addr=MAILTRAP_FROM_ADDR,
+        from_name=MAILTRAP_FROM_NAME,
+    ),
+    "gmail": dict(
+        host=GMAIL_HOST,
+        port=GMAIL_PORT,
+        username=GMAIL_USERNAME,
+        password=GMAIL_PASSWORD,
+        from_addr=GMAIL_FROM_ADDR,
+        from_name=GMAIL_FROM_NAME,
+    ),
+}
+
+
+def _build_message(from_addr, from_name, to_addr, subject, html_body, text_body: str | None = None) -> str:
     """
-    Low-level helper: send a single HTML email via the given SMTP settings.
+    Build the multipart/alternative message (plain-text fallback + HTML).
     """
     if text_body is None:
         text_body = "This is an HTML email. Please open it in an HTML-capable mail client."
@@ -40,8 +69,62 @@ def _send_via_smtp(host, port, username, password,
 
     msg.attach(MIMEText(text_body, "plain", "utf-8"))
     msg.attach(MIMEText(html_body, "html", "utf-8"))
+    return msg.as_string()
+
+
+class PreparedMessage:
+    """
+    A campaign message with everything that is the same for every recipient
+    (headers, encoded subject, the plain-text part, MIME boundaries) encoded
+    once. build() only base64-encodes the recipient's HTML and splices it in.
+
+    Produces the same bytes as _build_message() would with the same boundary.
+    """
+
+    _TO_MARK = "@@clicksafe-to@@"
+
+    def __init__(self, from_addr, from_name, subject, text_body: str | None = None):
+        if text_body is None:
+            text_body = "This is an HTML email. Please open it in an HTML-capable mail client."
+
+        msg = MIMEMultipart("alternative")
+        from_header = f"{from_name} <{from_addr}>" if from_name else from_addr
+
+        msg["From"] = from_header
+        msg["To"] = self._TO_MARK
+        msg["Subject"] = subject
+
+        msg.attach(MIMEText(text_body, "plain", "utf-8"))
+        msg.attach(MIMEText("", "html", "utf-8"))
+
+        skeleton = msg.as_string()
+        self.boundary = msg.get_boundary()
+        self._closing = f"\n--{self.boundary}--\n"
 
-    with smtplib.SMTP(host, port, timeout=20) as s:
+        before_to, after_to = skeleton.split(self._TO_MARK, 1)
+        self._head = before_to
+        self._middle = after_to[: -len(self._closing)]  # ends right where the HTML payload goes
+
+    def build(self, to_addr: str, html_body: str) -> str:
+        return (
+            self._head + to_addr + self._middle
+            + base64mime.body_encode(html_body.encode("utf-8"))
+            + self._closing
+        )
+
+
+def prepare_message(route: str, subject: str, text_body: str | None = None) -> PreparedMessage:
+    """PreparedMessage for everything a campaign sends through one route."""
+    cfg = ROUTES[route]
+    return PreparedMessage(cfg["from_addr"], cfg["from_name"], subject, text_body)
+
+
+def _open_smtp(host, port, username, password, timeout=20):
+    """
+    Open an SMTP session and do the EHLO / STARTTLS / EHLO / LOGIN handshake.
+    """
+    s = smtplib.SMTP(host, port, timeout=timeout)
+    try:
         s.ehlo()
         # Both Mailtrap and Gmail use TLS
         s.starttls()
@@ -49,45 +132,163 @@ def _send_via_smtp(host, port, username, password,
 
         if username and password:
             s.login(username, password)
+    except Exception:
+        s.close()
+        raise
+    return s
 
-        s.sendmail(from_addr, [to_addr], msg.as_string())
 
-def send_email(to_addr: str, subject: str, html_body: str, text_body: str | None = None):
+def _send_via_smtp(host, port, username, password,
+                   from_addr, from_name,
+                   to_addr, subject, html_body, text_body: str | None = None):
     """
-    High-level send function used by the app.
+    Low-level helper: send a single HTML email over a one-off SMTP connection.
+    """
+    message = _build_message(from_addr, from_name, to_addr, subject, html_body, text_body)
+
+    with _open_smtp(host, port, username, password) as s:
+        s.sendmail(from_addr, [to_addr], message)
+
+
+class SMTPPool:
+    """
+    A small pool of logged-in SMTP connections to one provider.
 
+    - at most `size` connections are open at once; callers block for a free one
+    - idle connections are reused for the next sendmail (no new handshake)
+    - a connection the server has closed is replaced and the send retried once
+    - a connection is recycled after `max_messages` sends
+    """
+
+    def __init__(self, host, port, username, password,
+                 size=SMTP_POOL_SIZE, max_messages=SMTP_POOL_MAX_MESSAGES, timeout=20):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_messages = max_messages
+        self.timeout = timeout
+
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()  # most recently used first: least likely to have timed out
+
+    def _connect(self):
+        smtp = _open_smtp(self.host, self.port, self.username, self.password, self.timeout)
+        return [smtp, 0]  # [connection, messages sent on it]
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn[0].quit()
+        except Exception:
+            conn[0].close()
+
+    def sendmail(self, from_addr, to_addrs, message: str):
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = None
+
+            try:
+                if conn is None:
+                    conn = self._connect()
+                try:
+                    conn[0].sendmail(from_addr, to_addrs, message)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    # Server dropped an idle connection: reconnect and retry once
+                    self._discard(conn)
+                    conn = self._connect()
+                    conn[0].sendmail(from_addr, to_addrs, message)
+            except smtplib.SMTPResponseException:
+                # The server rejected this message but the session is still usable
+                if conn is not None:
+                    self._release(conn)
+                raise
+            except Exception:
+                if conn is not None:
+                    self._discard(conn)
+                raise
+
+            conn[1] += 1
+            self._release(conn)
+
+    def _release(self, conn):
+        if conn[1] >= self.max_messages:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+
+    def close(self):
+        """Close every idle connection (in-flight ones close when returned)."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(route: str) -> SMTPPool:
+    """Shared SMTPPool for a route name ('mailtrap' or 'gmail'), created on first use."""
+    with _pools_lock:
+        pool = _pools.get(route)
+        if pool is None:
+            cfg = ROUTES[route]
+            pool = SMTPPool(cfg["host"], cfg["port"], cfg["username"], cfg["password"])
+            _pools[route] = pool
+        return pool
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+atexit.register(close_pools)
+
+
+def route_for(to_addr: str) -> str:
+    """
     Routing logic:
-    - If recipient ends with @example.com → send via Mailtrap
-    - Otherwise → send via Gmail (real)
+    - If recipient ends with @example.com → 'mailtrap' (test inbox)
+    - Otherwise → 'gmail' (real inbox)
     """
     domain = to_addr.split("@")[-1].lower()
+    return "mailtrap" if domain == "example.com" else "gmail"
 
-    if domain == "example.com":
-        # Route to Mailtrap (test inbox)
-        _send_via_smtp(
-            host=MAILTRAP_HOST,
-            port=MAILTRAP_PORT,
-            username=MAILTRAP_USERNAME,
-            password=MAILTRAP_PASSWORD,
-            from_addr=MAILTRAP_FROM_ADDR,
-            from_name=MAILTRAP_FROM_NAME,
-            to_addr=to_addr,
-            subject=subject,
-            html_body=html_body,
-            text_body=text_body,
-        )
-    else:
-        # Route to Gmail (real inbox)
-        _send_via_smtp(
-            host=GMAIL_HOST,
-            port=GMAIL_PORT,
-            username=GMAIL_USERNAME,
-            password=GMAIL_PASSWORD,
-            from_addr=GMAIL_FROM_ADDR,
-            from_name=GMAIL_FROM_NAME,
-            to_addr=to_addr,
-            subject=subject,
-            html_body=html_body,
-            text_body=text_body,
-        )
 
+def send_email(to_addr: str, subject: str, html_body: str, text_body: str | None = None,
+               pooled: bool = True):
+    """
+    High-level send function used by the app.
+
+    The provider is picked by route_for(). By default the message goes out
+    over that provider's shared connection pool; pass pooled=False to use a
+    one-off connection instead.
+    """
+    route = route_for(to_addr)
+    cfg = ROUTES[route]
+
+    if not pooled:
+        _send_via_smtp(to_addr=to_addr, subject=subject, html_body=html_body,
+                       text_body=text_body, **cfg)
+        return
+
+    message = _build_message(cfg["from_addr"], cfg["from_name"], to_addr, subject, html_body, text_body)
+    get_pool(route).sendmail(cfg["from_addr"], [to_addr], message)
+
+
+def send_prepared(to_addr: str, message: str):
+    """
+    Send a message already built with PreparedMessage.build(), over the
+    pool for the recipient's route.
+    """
+    route = route_for(to_addr)
+    get_pool(route).sendmail(ROUTES[route]["from_addr"], [to_addr], message)
@@ -0,0 +1,260 @@
+import atexit
+import threading
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import bindparam, select, update
+from .db import db, insert_ignore
+from .models import Campaign, CampaignRecipient, Recipient, Event
+from . import live, stats
+
+# --- Event write path --- #
+# Tracking hits (clicks, reports) are recorded here rather than in the views,
+# either straight away (record_event) or through the write-behind EventBuffer.
+
+
+def now():
+    """Timestamp stored on new events (UTC, like the rest of the app's writes)."""
+    return datetime.utcnow()
+
+
+def _record_statement():
+    """
+    INSERT IGNORE INTO events (...)
+    SELECT c.id, r.id, :event_type, :ip, :ts FROM campaigns c JOIN recipients r ON r.id = :rid
+    WHERE c.id = :cid
+
+    The SELECT only yields a row when both ids exist, and the unique index
+    on events turns a repeat (or a concurrent duplicate) into a no-op.
+    """
+    source = (
+        select(Campaign.id, Recipient.id, bindparam("event_type"), bindparam("ip"), bindparam("ts"))
+        .select_from(Campaign)
+        .join(Recipient, Recipient.id == bindparam("rid"))
+        .where(Campaign.id == bindparam("cid"))
+    )
+    return insert_ignore(Event.__table__).from_select(
+        ["campaign_id", "recipient_id", "event_type", "ip", "ts"], source
+    )
+
+
+def _write_events(rows):
+    """
+    Insert event dicts (cid, rid, event_type, ip, ts) and count the ones
+    that were new into the rollups (stats.py), in the current transaction.
+    Returns rows written.
+    """
+    stmt = _record_statement()
+    new = []
+    watched = []
+    for row in rows:
+        if db.session.execute(stmt, row).rowcount:
+            new.append((row["cid"], row["rid"], row["event_type"], row["ts"]))
+            if row["event_type"] in RECIPIENT_STATE_COLUMNS:
+                _update_recipient_state(row)
+                if live.watching(row["cid"]):
+                    watched.append(row)
+    stats.record(new)
+    if watched:
+        _queue_live_activity(watched)
+    return len(new)
+
+
+def _queue_live_activity(rows):
+    """Queue new clicks/reports for live subscribers (sent after commit, see live.py)."""
+    names = dict(db.session.execute(
+        select(Campaign.id, Campaign.name).where(Campaign.id.in_({row["cid"] for row in rows}))
+    ).all())
+    emails = dict(db.session.execute(
+        select(Recipient.id, Recipient.email).where(Recipient.id.in_({row["rid"] for row in rows}))
+    ).all())
+    for row in rows:
+        live.queue_activity(db.session, row["cid"], {
+            "campaign_id": row["cid"],
+            "campaign_name": names.get(row["cid"]),
+            "recipient_id": row["rid"],
+            "recipient_email": emails.get(row["rid"]),
+            "event_type": row["event_type"],
+            "ip": row["ip"],
+            "ts": str(row["ts"]),
+        })
+
+
+# campaign_recipients column set by the first event of each type
+RECIPIENT_STATE_COLUMNS = {"clicked": "clicked_at", "reported": "reported_at"}
+
+
+def _update_recipient_state(row):
+    """Stamp a new click/report on the (campaign, recipient) state row."""
+    values = {RECIPIENT_STATE_COLUMNS[row["event_type"]]: row["ts"]}
+    if row["event_type"] == "clicked":
+        values["click_ip"] = row["ip"]
+
+    updated = db.session.execute(
+        update(CampaignRecipient)
+        .where(CampaignRecipient.campaign_id == row["cid"], CampaignRecipient.recipient_id == row["rid"])
+        .values(values)
+    ).rowcount
+    if not updated:
+        # Campaigns sent before the state table existed have no row yet;
+        # a click or report shows the email did arrive
+        db.session.execute(
+            insert_ignore(CampaignRecipient.__table__),
+            dict(campaign_id=row["cid"], recipient_id=row["rid"], status="sent", attempts=0, **values),
+        )
+
+
+def record_event(cid: int, rid: int, event_type: str, ip: str | None = None) -> bool:
+    """
+    Record an event once per (campaign, recipient, event type), in a single
+    statement, and commit. Returns True if a new row was written.
+    """
+    written = _write_events([dict(cid=cid, rid=rid, event_type=event_type, ip=ip, ts=now())])
+    db.session.commit()
+    return written == 1
+
+
+def ids_exist(cid: int, rid: int) -> bool:
+    """Both the campaign and the recipient exist (one query)."""
+    return db.session.execute(
+        select(Campaign.id)
+        .select_from(Campaign)
+        .join(Recipient, Recipient.id == rid)
+        .where(Campaign.id == cid)
+    ).first() is not None
+
+
+class EventBuffer:
+    """
+    Write-behind buffer for tracking events.
+
+    add() only appends to an in-memory list; a background thread writes the
+    buffered events to `events` in one transaction when EVENT_BUFFER_SIZE
+    events are waiting or every EVENT_BUFFER_INTERVAL seconds, whichever
+    comes first. close() (run at interpreter exit) flushes what is left.
+    Events still buffered when the process is killed outright are lost.
+
+    When a batch fails, its rows are retried one at a time so a bad row
+    can't hold up the others; a row that has failed `max_attempts` flushes
+    is logged and dropped.
+    """
+
+    def __init__(self, app, max_size=500, interval=1.0, max_attempts=5):
+        self.app = app
+        self.max_size = max_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self._pending = {}  # (cid, rid, event_type) -> row; repeats collapse here already
+        self._failures = {}  # (cid, rid, event_type) -> failed flushes so far
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def add(self, cid: int, rid: int, event_type: str, ip: str | None = None):
+        with self._lock:
+            self._pending.setdefault(
+                (cid, rid, event_type),
+                dict(cid=cid, rid=rid, event_type=event_type, ip=ip, ts=now()),
+            )
+            full = len(self._pending) >= self.max_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="clicksafe-event-buffer", daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write everything buffered so far; returns the number of new rows."""
+        with self._lock:
+            rows = list(self._pending.values())
+            self._pending = {}
+        if not rows:
+            return 0
+
+        with self.app.app_context():
+            try:
+                return self._write(rows)
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception("Flushing %d buffered event(s) failed", len(rows))
+            if len(rows) == 1:
+                self._retry(rows)
+                return 0
+
+            # Find the failing rows so the rest still get written
+            written = 0
+            failed = []
+            for row in rows:
+                try:
+                    written += self._write([row])
+                except Exception:
+                    db.session.rollback()
+                    failed.append(row)
+            self._retry(failed)
+            return written
+
+    def _write(self, rows):
+        written = _write_events(rows)
+        db.session.commit()
+        with self._lock:
+            for row in rows:
+                self._failures.pop((row["cid"], row["rid"], row["event_type"]), None)
+        return written
+
+    def _retry(self, rows):
+        """Put failed rows back for the next flush, dropping those out of attempts."""
+        with self._lock:
+            for row in rows:
+                key = (row["cid"], row["rid"], row["event_type"])
+                attempts = self._failures.get(key, 0) + 1
+                if attempts >= self.max_attempts:
+                    self._failures.pop(key, None)
+                    self.app.logger.error(
+                        "Dropping %s event for campaign %s, recipient %s after %d failed attempts",
+                        row["event_type"], row["cid"], row["rid"], attempts,
+                    )
+                    continue
+                self._failures[key] = attempts
+                self._pending.setdefault(key, row)
+
+    def close(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+        self.flush()
+
+
+def init_app(app):
+    """Set up the write-behind buffer unless EVENT_BUFFER_ENABLED is off."""
+    if not app.config.get("EVENT_BUFFER_ENABLED", True):
+        return
+    buffer = EventBuffer(
+        app,
+        max_size=app.config.get("EVENT_BUFFER_SIZE", 500),
+        interval=app.config.get("EVENT_BUFFER_INTERVAL", 1.0),
+        max_attempts=app.config.get("EVENT_BUFFER_MAX_ATTEMPTS", 5),
+    )
+    app.extensions["event_buffer"] = buffer
+    atexit.register(buffer.close)
+
+
+def track_event(cid: int, rid: int, event_type: str, ip: str | None = None):
+    """
+    Record a tracking hit from a request.
+
+    Buffered (the default): returns None straight away; the row is written
+    by the next flush, which also drops unknown ids and repeats.
+    Synchronous (EVENT_BUFFER_ENABLED off): returns record_event()'s result.
+    """
+    buffer = current_app.extensions.get("event_buffer")
+    if buffer is None:
+        return record_event(cid, rid, event_type, ip)
+    buffer.add(cid, rid, event_type, ip)
+    return None
@@ -0,0 +1,277 @@
+import csv
+import io
+import os
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import bindparam, delete, func, or_, select, update
+from . import roster
+from .db import db, insert_ignore
+from .models import ImportJob, Recipient
+
+# --- Bulk recipient import --- #
+# Streams a "Name,Email" CSV a chunk at a time: emails are normalised and
+# de-duplicated in memory, existing recipients are found with one IN query
+# per chunk, then new ones are inserted and existing ones moved into the
+# department with one statement each. Every chunk is its own transaction.
+#
+# Uploads from the web UI run as ImportJobs: the file is spooled to
+# IMPORT_SPOOL_DIR and imported on the "import" job pool while the browser
+# watches the job's counters (see routes.import_status).
+
+CHUNK_SIZE = 1000
+
+
+def _normalise(email):
+    return (email or "").strip()
+
+
+def _rows(text_stream):
+    """(line number, name, email) for every CSV line, as the file is read."""
+    for line_no, row in enumerate(csv.reader(text_stream), 1):
+        name = row[0] if len(row) > 0 else ""
+        email = row[1] if len(row) > 1 else ""
+        yield line_no, name.strip(), _normalise(email)
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _existing(keys):
+    """lowercased email -> (id, name, department_id) for the recipients among `keys` (lowercased emails)."""
+    rows = db.session.execute(
+        select(Recipient.id, Recipient.email_lower, Recipient.name, Recipient.department_id)
+        .where(Recipient.email_lower.in_(keys))
+    ).all()
+    return {r.email_lower: r for r in rows}
+
+
+def import_recipients(binary_stream, department_id, chunk_size=CHUNK_SIZE, on_reject=None, on_chunk=None):
+    """
+    Import a CSV (Name, Email per line; UTF-8, BOM allowed) into a department.
+
+    - new emails become recipients of the department
+    - existing recipients are moved into the department, and get the CSV name
+      if they had none
+    - blank lines, a header line, malformed emails and repeats are skipped;
+      malformed ones are passed to on_reject(line_no, name, email, reason)
+
+    on_chunk(counts) is called after each committed chunk. Returns counts:
+    rows, inserted, updated, unchanged, skipped, rejected.
+    """
+    text = io.TextIOWrapper(binary_stream, encoding="utf-8-sig", newline="")
+    counts = dict(rows=0, inserted=0, updated=0, unchanged=0, skipped=0, rejected=0)
+    seen = set()  # lowercased emails already handled in this file
+
+    try:
+        for chunk in _chunks(_rows(text), chunk_size):
+            counts["rows"] += len(chunk)
+
+            # 1) Clean up and de-duplicate in memory
+            wanted = {}  # lowercased email -> (name, email as given)
+            for line_no, name, email in chunk:
+                if not email or (line_no == 1 and "@" not in email):
+                    counts["skipped"] += 1  # blank line or header
+                    continue
+                if "@" not in email or " " in email or len(email) > 255:
+                    counts["rejected"] += 1
+                    if on_reject is not None:
+                        on_reject(line_no, name, email, "invalid email address")
+                    continue
+                key = email.lower()
+                if key in seen:
+                    counts["skipped"] += 1
+                    continue
+                seen.add(key)
+                wanted[key] = (name[:150] or None, email)
+
+            if wanted:
+                _apply_chunk(wanted, department_id, counts)
+                roster.mark_changed()
+            db.session.commit()
+            if on_chunk is not None:
+                on_chunk(dict(counts))
+    finally:
+        text.detach()  # leave the caller's stream open
+    return counts
+
+
+def _move(condition, department_id):
+    """Put the recipients matching `condition` into the department; returns how many moved."""
+    return db.session.execute(
+        update(Recipient)
+        .where(condition, or_(Recipient.department_id.is_(None), Recipient.department_id != department_id))
+        .values(department_id=department_id)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def _apply_chunk(wanted, department_id, counts):
+    # 2) One IN query for the recipients that already exist
+    existing = _existing(list(wanted))
+
+    # 3) Insert the new ones in one statement
+    new_rows = [
+        {"name": name, "name_lower": name.lower() if name else None,
+         "email": email, "email_lower": key, "department_id": department_id}
+        for key, (name, email) in wanted.items()
+        if key not in existing
+    ]
+    if new_rows:
+        inserted = db.session.execute(insert_ignore(Recipient.__table__), new_rows).rowcount
+        counts["inserted"] += inserted
+        if inserted < len(new_rows):
+            # Another import added some of these emails in the meantime
+            counts["updated"] += _move(Recipient.email_lower.in_([r["email_lower"] for r in new_rows]), department_id)
+
+    # 4) Move existing recipients into the department with one UPDATE
+    to_move = [r.id for r in existing.values() if r.department_id != department_id]
+    if to_move:
+        counts["updated"] += _move(Recipient.id.in_(to_move), department_id)
+    counts["unchanged"] += len(existing) - len(to_move)
+
+    # Names only fill in blanks; an existing name is never overwritten
+    names = [
+        {"rid": r.id, "new_name": wanted[key][0], "new_name_lower": wanted[key][0].lower()}
+        for key, r in existing.items()
+        if not r.name and wanted[key][0]
+    ]
+    if names:
+        db.session.execute(
+            update(Recipient.__table__)
+            .where(Recipient.__table__.c.id == bindparam("rid"))
+            .values(name=bindparam("new_name"), name_lower=bindparam("new_name_lower")),
+            names,
+        )
+
+
+# --- Background import jobs --- #
+
+def upload_path(job_id):
+    return os.path.join(current_app.config["IMPORT_SPOOL_DIR"], f"import-{job_id}.csv")
+
+
+def rejects_path(job_id):
+    return os.path.join(current_app.config["IMPORT_SPOOL_DIR"], f"import-{job_id}-rejected.csv")
+
+
+def create_import_job(department_id, upload):
+    """
+    Spool an uploaded file (werkzeug FileStorage) to disk and add a queued
+    ImportJob for it to the session. The caller commits and submits
+    run_import_job(job.id).
+    """
+    expire_import_jobs()
+
+    job = ImportJob(department_id=department_id, filename=(upload.filename or "")[:255], status="queued")
+    db.session.add(job)
+    db.session.flush()  # need the id for the spool file name
+
+    os.makedirs(current_app.config["IMPORT_SPOOL_DIR"], exist_ok=True)
+    upload.save(upload_path(job.id))  # copies in blocks, not all in memory
+    return job
+
+
+def run_import_job(job_id):
+    """Import a spooled upload, keeping the job's counters current. Runs on the import pool."""
+    job = db.session.get(ImportJob, job_id)
+    if job is None or job.status != "queued":
+        return
+    job.status = "running"
+    job.started_at = datetime.utcnow()
+    db.session.commit()
+
+    rejects = None
+    rejects_writer = None
+
+    def on_reject(line_no, name, email, reason):
+        nonlocal rejects, rejects_writer
+        if rejects is None:
+            rejects = open(rejects_path(job_id), "w", newline="", encoding="utf-8")
+            rejects_writer = csv.writer(rejects)
+            rejects_writer.writerow(["line", "name", "email", "reason"])
+        rejects_writer.writerow([line_no, name, email, reason])
+
+    def on_chunk(counts):
+        if rejects is not None:
+            rejects.flush()  # so the rejected-rows download is current
+        db.session.execute(update(ImportJob).where(ImportJob.id == job_id).values(counts))
+        db.session.commit()
+
+    try:
+        with open(upload_path(job_id), "rb") as f:
+            counts = import_recipients(f, job.department_id, on_reject=on_reject, on_chunk=on_chunk)
+        if rejects is not None:
+            rejects.close()
+        db.session.execute(
+            update(ImportJob)
+            .where(ImportJob.id == job_id)
+            .values(status="done", finished_at=datetime.utcnow(), **counts)
+        )
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        if rejects is not None:
+            rejects.close()
+        db.session.execute(
+            update(ImportJob)
+            .where(ImportJob.id == job_id)
+            .values(status="failed", error=str(e), finished_at=datetime.utcnow())
+        )
+        db.session.commit()
+        raise
+    finally:
+        _remove(upload_path(job_id))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def expire_import_jobs(days=None):
+    """
+    Delete ImportJobs that finished (or were created, if they never did)
+    more than `days` ago (IMPORT_RETENTION_DAYS by default), with their
+    spool and rejected-rows files. Returns the number of jobs removed.
+    """
+    if days is None:
+        days = current_app.config.get("IMPORT_RETENTION_DAYS", 7)
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    old = db.session.scalars(
+        select(ImportJob.id).where(func.coalesce(ImportJob.finished_at, ImportJob.created_at) < cutoff)
+    ).all()
+    if not old:
+        return 0
+    for job_id in old:
+        _remove(upload_path(job_id))
+        _remove(rejects_path(job_id))
+    db.session.execute(delete(ImportJob).where(ImportJob.id.in_(old)))
+    return len(old)
+
+
+def import_progress(job):
+    """Status payload for an ImportJob (status page and its JSON endpoint)."""
+    end = job.finished_at or datetime.utcnow()
+    elapsed = (end.replace(tzinfo=None) - job.started_at.replace(tzinfo=None)).total_seconds() if job.started_at else 0
+    return {
+        "id": job.id,
+        "status": job.status,
+        "rows": job.rows,
+        "inserted": job.inserted,
+        "updated": job.updated,
+        "unchanged": job.unchanged,
+        "skipped": job.skipped,
+        "rejected": job.rejected,
+        "rows_per_second": round(job.rows / elapsed, 1) if elapsed > 0 else None,
+        "error": job.error,
+    }
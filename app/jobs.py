@@ -0,0 +1,44 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Background job runner --- #
+# Long-running work (e.g. delivering a campaign) is handed to a small thread
+# pool so the HTTP request that started it can return straight away.
+# Each kind of work has its own pool, so a big import can't hold up a send.
+
+# pool name -> config key holding its size
+POOLS = {
+    "send": "SEND_QUEUE_WORKERS",
+    "import": "IMPORT_WORKERS",
+}
+
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def _get_executor(app, pool):
+    with _executor_lock:
+        if pool not in _executors:
+            _executors[pool] = ThreadPoolExecutor(
+                max_workers=app.config.get(POOLS[pool], 2),
+                thread_name_prefix=f"clicksafe-{pool}",
+            )
+        return _executors[pool]
+
+
+def submit(app, fn, *args, pool="send", **kwargs):
+    """
+    Run fn(*args, **kwargs) on a background thread of `pool` inside an app context.
+
+    `app` must be the real application object (current_app._get_current_object()),
+    not the proxy, because the proxy is not usable outside the request.
+    """
+    def run():
+        with app.app_context():
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                app.logger.exception("Background job %s failed", getattr(fn, "__name__", fn))
+                raise
+
+    return _get_executor(app, pool).submit(run)
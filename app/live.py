@@ -0,0 +1,175 @@
+import json
+import queue
+import threading
+from flask import current_app
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from .db import db
+from .models import SendJob
+
+# --- Live campaign updates (Server-Sent Events) --- #
+# Browsers subscribe to a campaign (or to every campaign) and get:
+# - "progress": the send job's status and queued/sent/failed counters
+# - "activity": each new click/report as it is recorded
+#
+# Everything is pushed from the write path: the event writer queues its new
+# clicks/reports on the session and they are published once that
+# transaction commits; send checkpoints wake the progress watcher, which
+# reads the affected send_jobs rows once and fans the result out to every
+# subscriber. Sends done by worker processes (SEND_QUEUE_BACKEND=db) can't
+# wake it, so it also re-reads the watched jobs every LIVE_PROGRESS_INTERVAL
+# seconds: one small query per process, however many browsers are open.
+
+ALL = "*"  # subscribe to every campaign
+
+
+class Broker:
+    """In-process fan-out of live messages to subscriber queues."""
+
+    def __init__(self, app, interval=2.0, queue_size=256):
+        self.app = app
+        self.interval = interval
+        self.queue_size = queue_size
+        self._subscribers = {}  # campaign id or ALL -> set of queues
+        self._progress = {}  # campaign id -> last progress published
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    # -- subscribers --
+
+    def subscribe(self, campaign_id=ALL, progress=None):
+        """
+        Returns (queue, progress to show first). `progress` is the job's
+        progress as the caller just read it. It becomes the last published
+        value if nothing was published for the campaign yet. Otherwise the
+        last published value is returned instead. Either way the watcher only
+        sends this subscriber changes it hasn't shown yet.
+        """
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(campaign_id, set()).add(q)
+            if progress is not None and campaign_id != ALL:
+                progress = self._progress.setdefault(campaign_id, progress)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch_progress, name="clicksafe-live", daemon=True)
+                self._thread.start()
+        return q, progress
+
+    def unsubscribe(self, campaign_id, q):
+        with self._lock:
+            subscribers = self._subscribers.get(campaign_id)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[campaign_id]
+                    self._progress.pop(campaign_id, None)
+
+    def watching(self, campaign_id):
+        with self._lock:
+            return bool(self._subscribers.get(campaign_id) or self._subscribers.get(ALL))
+
+    def publish(self, campaign_id, kind, data):
+        with self._lock:
+            targets = list(self._subscribers.get(campaign_id, ())) + list(self._subscribers.get(ALL, ()))
+        for q in targets:
+            try:
+                q.put_nowait((kind, data))
+            except queue.Full:
+                pass  # a stalled browser misses updates rather than blocking writers
+
+    # -- send progress --
+
+    def progress_changed(self):
+        """Called after a commit that changed send job counters or status."""
+        self._wake.set()
+
+    def _watch_progress(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                watched = [cid for cid in self._subscribers if cid != ALL]
+            if not watched:
+                continue
+            try:
+                with self.app.app_context():
+                    rows = db.session.execute(
+                        select(SendJob.campaign_id, SendJob.status, SendJob.total, SendJob.sent, SendJob.failed)
+                        .where(SendJob.campaign_id.in_(watched))
+                    ).all()
+                    db.session.remove()
+            except Exception:
+                self.app.logger.exception("Reading send progress for live updates failed")
+                continue
+            for row in rows:
+                progress = progress_dict(row)
+                with self._lock:
+                    if self._progress.get(row.campaign_id) == progress:
+                        continue
+                    self._progress[row.campaign_id] = progress
+                self.publish(row.campaign_id, "progress", progress)
+
+
+def progress_dict(job):
+    """The progress payload for a send job row (same fields as progress.json)."""
+    return {
+        "campaign_id": job.campaign_id,
+        "status": job.status,
+        "total": job.total,
+        "queued": max(job.total - job.sent - job.failed, 0),
+        "sent": job.sent,
+        "failed": job.failed,
+    }
+
+
+def init_app(app):
+    app.extensions["live"] = Broker(app, interval=app.config.get("LIVE_PROGRESS_INTERVAL", 2.0))
+
+
+def _broker():
+    return current_app.extensions.get("live") if current_app else None
+
+
+# -- write path hooks (run inside the writer's transaction) --
+
+def watching(campaign_id):
+    """Anyone subscribed to this campaign? Lets writers skip building messages."""
+    broker = _broker()
+    return broker is not None and broker.watching(campaign_id)
+
+
+def queue_activity(session, campaign_id, data):
+    """Publish a new click/report once the current transaction commits."""
+    session.info.setdefault("live_activity", []).append((campaign_id, data))
+
+
+def queue_progress(session):
+    """Refresh watched send progress once the current transaction commits."""
+    session.info["live_progress"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_after_commit(session):
+    activity = session.info.pop("live_activity", None)
+    progress = session.info.pop("live_progress", None)
+    if not (activity or progress):
+        return
+    broker = _broker()
+    if broker is None:
+        return
+    for campaign_id, data in activity or ():
+        broker.publish(campaign_id, "activity", data)
+    if progress:
+        broker.progress_changed()
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_after_rollback(session):
+    session.info.pop("live_activity", None)
+    session.info.pop("live_progress", None)
+
+
+def sse(kind, data):
+    """One Server-Sent Events message."""
+    return f"event: {kind}\ndata: {json.dumps(data)}\n\n"
@@ -1,4 +1,5 @@
 from .db import db
+from sqlalchemy.orm import validates
 from sqlalchemy.sql import func
 
 class Department(db.Model):
@@ -16,6 +17,26 @@ class Recipient(db.Model):
 	created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
 	department_id = db.Column(db.Integer, db.ForeignKey("departments.id"), nullable=True)
 	department = db.relationship("Department", back_populates="recipients")
+	# lower(email) / lower(name), kept in sync by the validators below; lookups and search use these
+	email_lower = db.Column(db.String(255))
+	name_lower = db.Column(db.String(150))
+	__table_args__ = (
+		db.Index("ix_recipients_email_lower", "email_lower"),
+		db.Index("ix_recipients_name_lower", "name_lower"),
+		# A department's list, by email (and email/name prefix search within it)
+		db.Index("ix_recipients_department_email_lower", "department_id", "email_lower", "id"),
+		db.Index("ix_recipients_department_name_lower", "department_id", "name_lower"),
+	)
+
+	@validates("email")
+	def _sync_email_lower(self, key, email):
+		self.email_lower = email.lower() if email is not None else None
+		return email
+
+	@validates("name")
+	def _sync_name_lower(self, key, name):
+		self.name_lower = name.lower() if name is not None else None
+		return name
 
 class Campaign(db.Model):
 	__tablename__ = "campaigns"
@@ -32,3 +53,102 @@ class Event(db.Model):
 	event_type = db.Column(db.String(50), nullable=False)	# 'delivered', 'clicked', 'reported'
 	ip = db.Column(db.String(45))
 	ts = db.Column(db.DateTime(timezone=True), server_default=func.now())
+	__table_args__ = (
+		# One row per (campaign, recipient, event type): lets tracking record with INSERT IGNORE
+		db.Index("uq_events_campaign_recipient_type", "campaign_id", "recipient_id", "event_type", unique=True),
+		# A recipient's history, newest first
+		db.Index("ix_events_recipient_ts", "recipient_id", "ts"),
+		# Listings of one event type (clicks/reports), newest first, overall or
+		# per campaign, without reading through the delivered rows
+		db.Index("ix_events_type_id", "event_type", "id"),
+		db.Index("ix_events_campaign_type_id", "campaign_id", "event_type", "id"),
+	)
+
+class SendJob(db.Model):
+	__tablename__ = "send_jobs"
+	id = db.Column(db.Integer, primary_key=True)
+	campaign_id = db.Column(db.Integer, db.ForeignKey("campaigns.id", ondelete="CASCADE"), nullable=False, unique=True)
+	template_key = db.Column(db.String(100), nullable=False)
+	base_url = db.Column(db.String(255), nullable=False)	# used to build tracking links outside the request
+	department_ids = db.Column(db.Text)	# comma-separated ids; NULL means every recipient with a department
+	status = db.Column(db.String(20), nullable=False, default="queued")	# 'queued', 'running', 'done', 'failed'
+	total = db.Column(db.Integer, nullable=False, default=0)
+	sent = db.Column(db.Integer, nullable=False, default=0)
+	failed = db.Column(db.Integer, nullable=False, default=0)
+	error = db.Column(db.Text)
+	created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+	started_at = db.Column(db.DateTime(timezone=True))
+	finished_at = db.Column(db.DateTime(timezone=True))
+
+class ImportJob(db.Model):
+	"""A recipient CSV upload being imported in the background (see importer.py)."""
+	__tablename__ = "import_jobs"
+	id = db.Column(db.Integer, primary_key=True)
+	department_id = db.Column(db.Integer, db.ForeignKey("departments.id", ondelete="CASCADE"), nullable=False)
+	filename = db.Column(db.String(255))	# as uploaded, for display
+	status = db.Column(db.String(20), nullable=False, default="queued")	# 'queued', 'running', 'done', 'failed'
+	rows = db.Column(db.Integer, nullable=False, default=0)	# CSV lines read so far
+	inserted = db.Column(db.Integer, nullable=False, default=0)
+	updated = db.Column(db.Integer, nullable=False, default=0)	# moved in from another department
+	unchanged = db.Column(db.Integer, nullable=False, default=0)
+	skipped = db.Column(db.Integer, nullable=False, default=0)	# blank lines, header, repeats
+	rejected = db.Column(db.Integer, nullable=False, default=0)	# listed in the rejected-rows file
+	error = db.Column(db.Text)
+	created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+	started_at = db.Column(db.DateTime(timezone=True))
+	finished_at = db.Column(db.DateTime(timezone=True))
+
+class CampaignRecipient(db.Model):
+	"""
+	Per-recipient state for a campaign: the send checkpoint, plus when the
+	email was delivered, first clicked and reported (events stays the raw log).
+	"""
+	__tablename__ = "campaign_recipients"
+	campaign_id = db.Column(db.Integer, db.ForeignKey("campaigns.id", ondelete="CASCADE"), primary_key=True)
+	recipient_id = db.Column(db.Integer, db.ForeignKey("recipients.id", ondelete="CASCADE"), primary_key=True)
+	status = db.Column(db.String(20), nullable=False, default="pending")	# 'pending', 'sending', 'sent', 'failed'
+	attempts = db.Column(db.Integer, nullable=False, default=0)
+	next_attempt_at = db.Column(db.DateTime(timezone=True))	# retry backoff; NULL means "now"
+	last_error = db.Column(db.String(255))
+	delivered_at = db.Column(db.DateTime(timezone=True))
+	clicked_at = db.Column(db.DateTime(timezone=True))
+	reported_at = db.Column(db.DateTime(timezone=True))
+	click_ip = db.Column(db.String(45))	# IP of the first click
+	__table_args__ = (
+		db.Index("ix_campaign_recipients_status", "campaign_id", "status", "recipient_id"),
+	)
+
+class SendBatch(db.Model):
+	"""A range of a campaign's recipients that one worker claims and sends."""
+	__tablename__ = "send_batches"
+	id = db.Column(db.Integer, primary_key=True)
+	job_id = db.Column(db.Integer, db.ForeignKey("send_jobs.id", ondelete="CASCADE"), nullable=False)
+	campaign_id = db.Column(db.Integer, db.ForeignKey("campaigns.id", ondelete="CASCADE"), nullable=False)
+	first_recipient_id = db.Column(db.Integer, nullable=False)	# inclusive range over campaign_recipients.recipient_id
+	last_recipient_id = db.Column(db.Integer, nullable=False)
+	status = db.Column(db.String(20), nullable=False, default="queued")	# 'queued', 'claimed', 'done'
+	available_at = db.Column(db.DateTime(timezone=True), nullable=False)	# not claimable before this (retry backoff)
+	claimed_by = db.Column(db.String(100))
+	lease_expires_at = db.Column(db.DateTime(timezone=True))	# a claim past this is abandoned and can be re-claimed
+	__table_args__ = (
+		db.Index("ix_send_batches_claim", "status", "available_at"),
+		db.Index("ix_send_batches_job", "job_id", "status"),
+	)
+
+class CampaignStats(db.Model):
+	"""Per-campaign event totals, kept up to date by the event write path (see stats.py)."""
+	__tablename__ = "campaign_stats"
+	campaign_id = db.Column(db.Integer, db.ForeignKey("campaigns.id", ondelete="CASCADE"), primary_key=True)
+	delivered = db.Column(db.Integer, nullable=False, default=0)
+	clicked = db.Column(db.Integer, nullable=False, default=0)
+	reported = db.Column(db.Integer, nullable=False, default=0)
+
+class EventBucket(db.Model):
+	"""Event counts per time bucket, campaign, department and event type (see stats.py)."""
+	__tablename__ = "event_buckets"
+	granularity = db.Column(db.String(10), primary_key=True)	# 'day' or 'hour'
+	bucket_start = db.Column(db.DateTime, primary_key=True)	# UTC start of the day/hour
+	campaign_id = db.Column(db.Integer, db.ForeignKey("campaigns.id", ondelete="CASCADE"), primary_key=True)
+	department_id = db.Column(db.Integer, primary_key=True, autoincrement=False)	# 0 = recipient had no department
+	event_type = db.Column(db.String(50), primary_key=True)
+	count = db.Column(db.Integer, nullable=False, default=0)
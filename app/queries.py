@@ -0,0 +1,292 @@
+from datetime import datetime, timedelta
+from sqlalchemy import case, distinct, func, or_, select, tuple_
+from .db import db
+from .models import Campaign, Department, Event, Recipient
+
+# --- Event listing queries --- #
+# The results page, its CSV export and /api/events all list events with the
+# same filters, read from the query string, and page through them by event
+# id (keyset pagination) instead of OFFSET, so page 1000 costs the same as
+# page 1.
+
+# Event types the results table shows when no type is picked
+DEFAULT_EVENT_TYPES = ("clicked", "reported")
+
+# Every event type the filters offer
+EVENT_TYPES = ("delivered", "clicked", "reported")
+
+
+def parse_day(value):
+    """A YYYY-MM-DD query-string value as a datetime, or None if missing/invalid."""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return None
+
+
+def filters_from_args(args):
+    """
+    The event filters in a request's query string:
+    campaign_id, event_type, department_id, start and end (YYYY-MM-DD, inclusive).
+    Missing or invalid values come back as None.
+    """
+    event_type = (args.get("event_type") or "").strip()
+    return dict(
+        campaign_id=args.get("campaign_id", type=int),
+        event_type=event_type if event_type in EVENT_TYPES else None,
+        department_id=args.get("department_id", type=int),
+        start=parse_day(args.get("start")),
+        end=parse_day(args.get("end")),
+    )
+
+
+def filter_args(filters):
+    """The filters back as query-string arguments (for links), empty ones left out."""
+    out = {}
+    for key, value in filters.items():
+        if value:
+            out[key] = value.strftime("%Y-%m-%d") if isinstance(value, datetime) else value
+    return out
+
+
+def event_rows(filters, default_types=DEFAULT_EVENT_TYPES):
+    """
+    SELECT of the event listing columns (event_id, cid, campaign_name,
+    recipient_id, recipient_email, event_type, ip, ts) with the filters
+    applied, unordered. `default_types` applies when no event type is picked
+    (None = every type).
+    """
+    query = (
+        select(
+            Event.id.label("event_id"),
+            Campaign.id.label("cid"),
+            Campaign.name.label("campaign_name"),
+            Recipient.id.label("recipient_id"),
+            Recipient.email.label("recipient_email"),
+            Event.event_type,
+            Event.ip,
+            Event.ts,
+        )
+        .join(Campaign, Campaign.id == Event.campaign_id)
+        .join(Recipient, Recipient.id == Event.recipient_id)
+    )
+
+    if filters.get("event_type"):
+        query = query.where(Event.event_type == filters["event_type"])
+    elif default_types:
+        query = query.where(Event.event_type.in_(default_types))
+    if filters.get("campaign_id"):
+        query = query.where(Event.campaign_id == filters["campaign_id"])
+    if filters.get("department_id"):
+        query = query.where(Recipient.department_id == filters["department_id"])
+    if filters.get("start"):
+        query = query.where(Event.ts >= filters["start"])
+    if filters.get("end"):
+        query = query.where(Event.ts < filters["end"] + timedelta(days=1))
+    return query
+
+
+def page_of_events(filters, before=None, after=None, limit=50, default_types=DEFAULT_EVENT_TYPES):
+    """
+    One page of events, newest first.
+
+    before: events with an id below this (the next, older page)
+    after:  events with an id above this (the previous, newer page)
+    Returns (rows, older_cursor, newer_cursor); a cursor is None when there
+    is nothing further in that direction.
+    """
+    query = event_rows(filters, default_types)
+    if after is not None:
+        # Walk upwards from the cursor, then flip back to newest-first
+        rows = db.session.execute(
+            query.where(Event.id > after).order_by(Event.id.asc()).limit(limit + 1)
+        ).all()
+        has_newer = len(rows) > limit
+        rows = rows[:limit][::-1]
+        has_older = True
+    else:
+        if before is not None:
+            query = query.where(Event.id < before)
+        rows = db.session.execute(query.order_by(Event.id.desc()).limit(limit + 1)).all()
+        has_older = len(rows) > limit
+        rows = rows[:limit]
+        has_newer = before is not None
+
+    older = rows[-1].event_id if rows and has_older else None
+    newer = rows[0].event_id if rows and has_newer else None
+    return rows, older, newer
+
+
+def iter_events(filters, batch_size=1000, default_types=DEFAULT_EVENT_TYPES):
+    """
+    Every matching event, newest first, fetched a keyset page at a time so
+    memory stays flat and no cursor is held open between pages.
+    """
+    before = None
+    while True:
+        rows, before, _ = page_of_events(filters, before=before, limit=batch_size, default_types=default_types)
+        yield from rows
+        if before is None:
+            return
+
+
+def recipient_summary(recipient_id):
+    """
+    One recipient's totals, in SQL: a row of (delivered, clicked, reported,
+    campaigns), plus the distinct event types and campaign names they have.
+    """
+    totals = db.session.execute(
+        select(
+            *[func.coalesce(func.sum(case((Event.event_type == t, 1), else_=0)), 0) for t in EVENT_TYPES],
+            func.count(distinct(Event.campaign_id)),
+        ).where(Event.recipient_id == recipient_id)
+    ).one()
+    event_types = db.session.scalars(
+        select(Event.event_type).where(Event.recipient_id == recipient_id).distinct().order_by(Event.event_type)
+    ).all()
+    campaign_names = db.session.scalars(
+        select(Campaign.name)
+        .where(Campaign.id.in_(select(Event.campaign_id).where(Event.recipient_id == recipient_id)))
+        .order_by(Campaign.name)
+    ).all()
+    return totals, event_types, campaign_names
+
+
+def recipient_events_page(recipient_id, event_type=None, before=None, after=None, limit=50):
+    """
+    One page of a recipient's events (event_id, event_type, ip, ts,
+    campaign_name), newest first by (ts, id) so it walks the
+    (recipient_id, ts) index. before/after are event ids, as in
+    page_of_events(); returns (rows, older_cursor, newer_cursor).
+    """
+    query = (
+        select(Event.id.label("event_id"), Event.event_type, Event.ip, Event.ts, Campaign.name.label("campaign_name"))
+        .join(Campaign, Campaign.id == Event.campaign_id)
+        .where(Event.recipient_id == recipient_id)
+    )
+    if event_type:
+        query = query.where(Event.event_type == event_type)
+
+    def position(event_id):
+        # The cursor event's sort key; None if it is gone
+        return db.session.execute(
+            select(Event.ts, Event.id).where(Event.id == event_id, Event.recipient_id == recipient_id)
+        ).first()
+
+    cursor = position(after) if after is not None else position(before) if before is not None else None
+    if after is not None and cursor is not None:
+        rows = db.session.execute(
+            query.where(tuple_(Event.ts, Event.id) > tuple(cursor))
+            .order_by(Event.ts.asc(), Event.id.asc())
+            .limit(limit + 1)
+        ).all()
+        has_newer = len(rows) > limit
+        rows = rows[:limit][::-1]
+        has_older = True
+    else:
+        if cursor is not None:
+            query = query.where(tuple_(Event.ts, Event.id) < tuple(cursor))
+        rows = db.session.execute(query.order_by(Event.ts.desc(), Event.id.desc()).limit(limit + 1)).all()
+        has_older = len(rows) > limit
+        rows = rows[:limit]
+        has_newer = cursor is not None
+
+    older = rows[-1].event_id if rows and has_older else None
+    newer = rows[0].event_id if rows and has_newer else None
+    return rows, older, newer
+
+
+# --- Recipient listing and search --- #
+# A department's recipients are listed by lower-cased email, a page at a
+# time with (email_lower, id) as the keyset, and searched by email or name
+# prefix on the lower-cased columns; both walk the (department_id,
+# email_lower, id) and (department_id, name_lower) indexes, or the
+# email_lower / name_lower indexes when searching every department.
+
+def _prefix(q):
+    """A LIKE pattern matching values that start with q (wildcards in q taken literally)."""
+    escaped = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%"
+
+
+def recipient_search(q):
+    """Condition: email or name starts with q (case-insensitive)."""
+    pattern = _prefix(q.strip().lower())
+    return or_(
+        Recipient.email_lower.like(pattern, escape="\\"),
+        Recipient.name_lower.like(pattern, escape="\\"),
+    )
+
+
+def department_recipients_page(department_id, q=None, before=None, after=None, limit=50):
+    """
+    One page of a department's recipients (id, name, email), by email.
+
+    q:      only recipients whose email or name starts with it
+    after:  recipients sorting after this recipient id (the next page)
+    before: recipients sorting before it (the previous page)
+    Returns (rows, prev_cursor, next_cursor); a cursor is None when there
+    is nothing further in that direction.
+    """
+    query = select(Recipient.id, Recipient.name, Recipient.email).where(Recipient.department_id == department_id)
+    if q and q.strip():
+        query = query.where(recipient_search(q))
+
+    def position(rid):
+        # The cursor recipient's sort key; None if it is gone or has moved
+        return db.session.execute(
+            select(Recipient.email_lower, Recipient.id)
+            .where(Recipient.id == rid, Recipient.department_id == department_id)
+        ).first()
+
+    key = tuple_(Recipient.email_lower, Recipient.id)
+    cursor = position(before) if before is not None else position(after) if after is not None else None
+    if before is not None and cursor is not None:
+        # Walk backwards from the cursor, then flip back to email order
+        rows = db.session.execute(
+            query.where(key < tuple(cursor))
+            .order_by(Recipient.email_lower.desc(), Recipient.id.desc())
+            .limit(limit + 1)
+        ).all()
+        has_prev = len(rows) > limit
+        rows = rows[:limit][::-1]
+        has_next = True
+    else:
+        if cursor is not None:
+            query = query.where(key > tuple(cursor))
+        rows = db.session.execute(
+            query.order_by(Recipient.email_lower.asc(), Recipient.id.asc()).limit(limit + 1)
+        ).all()
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+        has_prev = cursor is not None
+
+    prev = rows[0].id if rows and has_prev else None
+    next_ = rows[-1].id if rows and has_next else None
+    return rows, prev, next_
+
+
+def typeahead_recipients(q, department_id=None, limit=10):
+    """
+    Up to `limit` recipients (id, name, email, department_id, department_name)
+    whose email or name starts with q, by email, for lookup-as-you-type.
+    """
+    query = (
+        select(Recipient.id, Recipient.name, Recipient.email, Recipient.department_id,
+               Department.name.label("department_name"))
+        .outerjoin(Department, Department.id == Recipient.department_id)
+        .where(recipient_search(q))
+    )
+    if department_id is not None:
+        query = query.where(Recipient.department_id == department_id)
+    return db.session.execute(query.order_by(Recipient.email_lower, Recipient.id).limit(limit)).all()
+
+
+def campaign_options():
+    """(id, name) of every campaign, newest first, for filter dropdowns."""
+    return db.session.execute(select(Campaign.id, Campaign.name).order_by(Campaign.id.desc())).all()
+
+
+def department_options():
+    """(id, name) of every department, by name, for filter dropdowns."""
+    return db.session.execute(select(Department.id, Department.name).order_by(Department.name)).all()
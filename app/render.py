@@ -0,0 +1,110 @@
+import re
+import secrets
+import threading
+from markupsafe import escape
+
+# --- Pre-compiled campaign emails --- #
+# A campaign sends the same template to every recipient; only a handful of
+# values change (links, recipient fields, decoy details). CompiledEmail runs
+# Jinja once with marker strings in those slots, keeps the static HTML
+# between the markers, and afterwards renders a recipient by joining the
+# static segments with that recipient's (escaped) values.
+
+# Per-recipient values passed to the email templates (besides `recipient`)
+SLOT_NAMES = ("tracking_url", "report_url", "date", "country", "platform", "browser", "ip")
+
+# Recipient attributes the templates may use
+RECIPIENT_FIELDS = ("id", "email", "name")
+
+
+class _RecipientMarker:
+    """Stands in for the recipient while compiling; falsy fields stay falsy."""
+
+    def __init__(self, marker, shape):
+        for field, truthy in zip(RECIPIENT_FIELDS, shape):
+            setattr(self, field, marker(f"recipient.{field}") if truthy else None)
+
+
+class CompiledEmail:
+    """
+    Fast renderer for one campaign's email template.
+
+    render(slots, recipient) returns exactly what
+    tmpl.render(**slots, recipient=recipient, campaign=campaign) would.
+    Templates can branch on whether a recipient field is empty
+    (e.g. `recipient.name if recipient.name else ""`), so the template is
+    compiled once per "shape" (which recipient fields are truthy).
+
+    verify:
+    - "off":    trust the compiled segments
+    - "sample": check the first recipient of each shape against Jinja (default)
+    - "all":    check every recipient
+    A shape whose output differs from Jinja (say a filter is applied to a slot)
+    is logged and permanently falls back to plain Jinja rendering.
+    """
+
+    def __init__(self, tmpl, campaign, verify="sample", logger=None):
+        self.tmpl = tmpl
+        self.campaign = campaign
+        self.verify = verify
+        self.logger = logger
+        self._escape = escape if tmpl.environment.autoescape else str
+        self._nonce = secrets.token_hex(8)
+        self._pattern = re.compile(rf"@@cs{self._nonce}:([a-z_.]+)@@")
+        self._shapes = {}  # shape -> (segments, slot names) or None for "use Jinja"
+        self._verified = set()
+        self._lock = threading.Lock()
+
+    def _marker(self, name):
+        return f"@@cs{self._nonce}:{name}@@"
+
+    def _compile(self, shape):
+        html = self.tmpl.render(
+            recipient=_RecipientMarker(self._marker, shape),
+            campaign=self.campaign,
+            **{name: self._marker(name) for name in SLOT_NAMES},
+        )
+        parts = self._pattern.split(html)
+        # split() alternates: static, slot, static, slot, ..., static
+        return parts[0::2], parts[1::2]
+
+    def _jinja(self, slots, recipient):
+        return self.tmpl.render(recipient=recipient, campaign=self.campaign, **slots)
+
+    def render(self, slots, recipient):
+        shape = tuple(bool(getattr(recipient, f, None)) for f in RECIPIENT_FIELDS)
+
+        with self._lock:
+            if shape not in self._shapes:
+                self._shapes[shape] = self._compile(shape)
+            compiled = self._shapes[shape]
+            check = self.verify == "all" or (self.verify == "sample" and shape not in self._verified)
+
+        if compiled is None:
+            return self._jinja(slots, recipient)
+
+        segments, names = compiled
+        values = [
+            self._escape(getattr(recipient, name[10:]) if name.startswith("recipient.") else slots[name])
+            for name in names
+        ]
+        out = [segments[0]]
+        for value, segment in zip(values, segments[1:]):
+            out.append(value)
+            out.append(segment)
+        html = "".join(out)
+
+        if check:
+            expected = self._jinja(slots, recipient)
+            with self._lock:
+                self._verified.add(shape)
+                if html != expected:
+                    self._shapes[shape] = None
+                    if self.logger is not None:
+                        self.logger.warning(
+                            "Compiled template %s differs from Jinja output for shape %s; using Jinja",
+                            self.tmpl.name, shape,
+                        )
+            return expected
+
+        return html
@@ -0,0 +1,46 @@
+from flask import current_app
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from .cache import TTLCache
+from .db import db
+from .models import Department, Recipient
+
+# --- Department roster --- #
+# Every department with its member count, from one grouped query. The
+# departments and send pages both show it, so it is cached; code that adds,
+# imports, moves or deletes recipients (or departments) calls mark_changed()
+# and the cache is cleared once that transaction commits. The TTL only
+# matters for changes made by other processes (e.g. bulk_recipients.py).
+
+roster_cache = TTLCache(max_entries=1)
+
+
+def departments():
+    """[(id, name, num_recipients)] for every department, by name, cached."""
+    roster_cache.ttl = current_app.config.get("ROSTER_CACHE_TTL", 300)
+    return roster_cache.get("departments", _load)
+
+
+def _load():
+    return db.session.execute(
+        select(Department.id, Department.name, func.count(Recipient.id).label("num_recipients"))
+        .outerjoin(Recipient, Recipient.department_id == Department.id)
+        .group_by(Department.id, Department.name)
+        .order_by(Department.name.asc())
+    ).all()
+
+
+def mark_changed(session=None):
+    """Clear the roster when the current transaction commits."""
+    (session or db.session).info["roster_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    if session.info.pop("roster_changed", False):
+        roster_cache.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_after_rollback(session):
+    session.info.pop("roster_changed", None)
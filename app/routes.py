@@ -1,14 +1,16 @@
-from flask import Blueprint, render_template, request, redirect, url_for, Response, abort, flash, current_app, session
+from flask import Blueprint, render_template, request, redirect, url_for, Response, abort, flash, current_app, session, jsonify, stream_with_context, send_file
 from functools import wraps
-from sqlalchemy import func
 from .db import db
-from .models import Recipient, Campaign, Event, Department
-from .emailer import send_email
-from datetime import datetime
+from .models import Recipient, Campaign, Event, Department, SendJob, CampaignRecipient, SendBatch, CampaignStats, EventBucket, ImportJob
+from .sender import create_send_job, run_send_job
+from .events import track_event, ids_exist
+from .tokens import read_token
+from . import analytics, bulk, export, importer, jobs, live, queries, roster, stats
+from datetime import datetime, timedelta
 from flask import current_app
-import random
 import csv
 import io
+import os
 
 # Subject lines for each email template
 TEMPLATE_SUBJECTS = {
@@ -82,25 +84,14 @@ def logout():
 @login_required
 def send_campaign():
     if request.method == "GET":
-        # Load departments with recipient counts
-        departments = (
-            Department.query.outerjoin(Recipient)
-            .add_columns(
-                Department.id,
-                Department.name,
-                db.func.count(Recipient.id).label("num_recipients"),
-            )
-            .group_by(Department.id)
-            .order_by(Department.name.asc())
-            .all()
-        )
+        # Departments with recipient counts (cached, see roster.py)
         return render_template(
             "send.html",
             title="Launch Campaign",
-            departments=departments,
+            departments=roster.departments(),
         )
 
-    # ---------- POST: create campaign, send emails, record 'delivered' ---------- #
+    # ---------- POST: create campaign, queue delivery, show progress ---------- #
 
     # Which template was selected in the dropdown
     template_key = request.form.get("email_template", "").strip()
@@ -108,6 +99,16 @@ def send_campaign():
     # Subject line is driven by the template
     subject = TEMPLATE_SUBJECTS.get(template_key, "Phishing Simulation")
 
+    # ---------- Resolve recipients ---------- #
+    use_all = request.form.get("use_all") == "on"
+    if use_all:
+        department_ids = None
+    else:
+        department_ids = [int(x) for x in request.form.getlist("departments") if x.isdigit()]
+        if not department_ids:
+            flash("Please select at least one department", "warning")
+            return redirect(url_for("main.send_campaign"))
+
     # 1) Create campaign with a temporary name so we can get an ID
     campaign = Campaign(name="(pending name)", subject=subject)
     db.session.add(campaign)
@@ -116,123 +117,184 @@ def send_campaign():
     # 2) Auto-generate a friendly campaign name based on ID + template
     display_name = TEMPLATE_DISPLAY_NAMES.get(template_key, subject)
     campaign.name = f"Campaign #{campaign.id} – {display_name}"
+
+    # 3) Queue the delivery job; the emails go out on a background thread
+    #    here, or on worker.py processes when SEND_QUEUE_BACKEND is "db"
+    job = create_send_job(campaign, template_key, request.url_root.rstrip("/"), department_ids)
     db.session.commit()
 
-    # ---------- Resolve recipients ---------- #
-    use_all = request.form.get("use_all") == "on"
-    if use_all:
-        send_to = Recipient.query.filter(
-            Recipient.department_id.isnot(None)
-        ).all()
-    else:
-        selected_dept_ids = request.form.getlist("departments")  # list of strings
-        if not selected_dept_ids:
-            flash("Please select at least one department", "warning")
-            return redirect(url_for("main.send_campaign"))
+    if current_app.config.get("SEND_QUEUE_BACKEND", "thread") == "thread":
+        jobs.submit(current_app._get_current_object(), run_send_job, job.id)
 
-        send_to = Recipient.query.filter(
-            Recipient.department_id.in_(selected_dept_ids)
-        ).all()
-
-    sent_count = 0
-    base = request.url_root.rstrip("/")
-
-    # Use the same key for picking the email template file
-    tmpl = current_app.jinja_env.get_template(f"email/{template_key}.html")
-
-    for r in send_to:
-        tracking_url = f"{base}/l/{campaign.id}/{r.id}"
-        report_url   = f"{base}/r/{campaign.id}/{r.id}"
-
-        # Optional realistic fields
-        date     = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S +0000")
-        country  = random.choice(["Russia", "Canada", "USA", "Mexico", "India", "China"])
-        platform = random.choice(["Windows 10", "Windows 11", "macOS 12"])
-        browser  = random.choice(["Chrome", "Firefox", "Edge"])
-
-        def _random_ipv4():
-            return ".".join(str(random.randint(10, 250)) for _ in range(4))
-        ip = _random_ipv4()
-
-        body_for_recipient = tmpl.render(
-            tracking_url=tracking_url,
-            report_url=report_url,
-            recipient=r,
-            campaign=campaign,
-            date=date,
-            country=country,
-            platform=platform,
-            browser=browser,
-            ip=ip,
-        )
+    return redirect(url_for("main.send_progress", cid=campaign.id))
 
-        # Send & record 'delivered'
-        send_email(r.email, subject, body_for_recipient)
-        db.session.add(
-            Event(
-                campaign_id=campaign.id,
-                recipient_id=r.id,
-                event_type="delivered",
-            )
-        )
-        sent_count += 1
 
-    db.session.commit()
-    recipients_sent = send_to
+@bp.route("/send/<int:cid>/progress", methods=["GET"])
+@login_required
+def send_progress(cid: int):
+    campaign = Campaign.query.get_or_404(cid)
+    job = SendJob.query.filter_by(campaign_id=cid).first_or_404()
 
     return render_template(
         "send_done.html",
-        title="Campaign Sent",
+        title="Campaign Queued",
         campaign=campaign,
-        sent=sent_count,
-        recipients=recipients_sent,
+        job=job,
     )
 
-	
+
+@bp.route("/send/<int:cid>/resume", methods=["POST"])
+@login_required
+def resume_send(cid: int):
+    """Restart a delivery job that stopped with an error; sent recipients are skipped."""
+    job = SendJob.query.filter_by(campaign_id=cid).first_or_404()
+    if job.status == "failed":
+        job.status = "queued"
+        job.error = None
+        db.session.commit()
+        if current_app.config.get("SEND_QUEUE_BACKEND", "thread") == "thread":
+            jobs.submit(current_app._get_current_object(), run_send_job, job.id)
+        flash("Delivery resumed.", "success")
+    return redirect(url_for("main.send_progress", cid=cid))
+
+
+@bp.route("/send/<int:cid>/progress.json", methods=["GET"])
+@login_required
+def send_progress_json(cid: int):
+    """Polled by the progress page to refresh the queued/sent/failed counters."""
+    job = SendJob.query.filter_by(campaign_id=cid).first_or_404()
+    return jsonify(live.progress_dict(job))
+
+@bp.route("/imports/<int:job_id>", methods=["GET"])
+@login_required
+def import_status(job_id: int):
+    """Progress page for a background recipient import."""
+    job = ImportJob.query.get_or_404(job_id)
+    return render_template(
+        "import_status.html",
+        title="Recipient import",
+        job=job,
+        department=Department.query.get(job.department_id),
+        progress=importer.import_progress(job),
+        has_rejects=os.path.exists(importer.rejects_path(job.id)),
+    )
+
+@bp.route("/imports/<int:job_id>.json", methods=["GET"])
+@login_required
+def import_status_json(job_id: int):
+    """Polled by the import page to refresh the counters."""
+    job = ImportJob.query.get_or_404(job_id)
+    return jsonify(importer.import_progress(job))
+
+@bp.route("/imports/<int:job_id>/rejected.csv", methods=["GET"])
+@login_required
+def import_rejects(job_id: int):
+    """The rows an import rejected, with the line number and reason."""
+    job = ImportJob.query.get_or_404(job_id)
+    path = importer.rejects_path(job.id)
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype="text/csv", as_attachment=True, download_name=f"import-{job.id}-rejected.csv")
+
+@bp.route("/live", methods=["GET"])
+@login_required
+def live_stream():
+    """
+    Server-Sent Events stream of "progress" (send counters) and "activity"
+    (new clicks/reports) messages for ?campaign_id=, or activity for every
+    campaign without it. Messages are pushed from the write path (live.py).
+    """
+    import queue
+
+    cid = request.args.get("campaign_id", type=int)
+    key = cid or live.ALL
+    broker = current_app.extensions["live"]
+
+    job = SendJob.query.filter_by(campaign_id=cid).first() if cid else None
+    initial = live.progress_dict(job) if job else None
+    # Don't hold a DB connection for as long as the browser stays connected
+    db.session.close()
+
+    # The broker won't publish this snapshot again (see Broker.subscribe)
+    subscription, initial = broker.subscribe(key, initial)
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            if initial:
+                yield live.sse("progress", initial)
+            while True:
+                try:
+                    kind, data = subscription.get(timeout=15)
+                except queue.Empty:
+                    # Comment line: keeps proxies from timing out and
+                    # notices disconnected browsers
+                    yield ": keepalive\n\n"
+                    continue
+                yield live.sse(kind, data)
+        finally:
+            broker.unsubscribe(key, subscription)
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def _client_ip():
+    """Client IP (handles proxies too: take the first X-Forwarded-For hop)."""
+    ip = request.headers.get("X-Forwarded-For", request.remote_addr)
+    if ip and "," in ip:
+        ip = ip.split(",")[0].strip()
+    return ip
+
 
 @bp.route("/l/<int:cid>/<int:rid>", methods=["GET"])
 def track_click(cid: int, rid: int):
 	""" Record a click event for campaign cid and recipient rid, then respond. """
-	# Validate foreign ids exist (keep data clean)
-	campaign = Campaign.query.get(cid)
-	recipient = Recipient.query.get(rid)
-	if not campaign or not recipient:
-		return abort(404)
-
-	# Get client IP (handles proxies too)
-	ip = request.headers.get("X-Forwarded-For", request.remote_addr)
-	if ip and "," in ip: # if behind proxy, take first hop
-		ip = ip.split(",")[0].strip()
-
-	# Avoid duplicate 'clicked' rows for this (cid, rid)
-	already = (Event.query.filter_by(campaign_id=cid, recipient_id=rid, event_type="clicked").first())
-	if not already:
-		db.session.add(Event(campaign_id=cid, recipient_id=rid, event_type="clicked", ip=ip))
-		db.session.commit()
+	# One INSERT IGNORE (now or at the next buffer flush): validates both
+	# ids and skips repeat clicks. Unknown ids insert nothing, and the
+	# feedback page 404s on them.
+	track_event(cid, rid, "clicked", _client_ip())
 
 	# Landing page
 	return redirect(url_for("main.feedback", cid=cid, rid=rid))
 
+@bp.route("/l/<token>", methods=["GET"])
+def track_click_token(token: str):
+    """Signed-link version of track_click: the signature vouches for the ids."""
+    ids = read_token(token)
+    if ids is None:
+        return abort(404)
+    cid, rid, _ = ids
+
+    track_event(cid, rid, "clicked", _client_ip())
+    return redirect(url_for("main.feedback_token", token=token))
+
 @bp.route("/r/<int:cid>/<int:rid>", methods=["GET"])
 def track_report(cid: int, rid: int):
     """Record a 'reported' event and show a popup message instead of redirecting."""
-    campaign = Campaign.query.get(cid)
-    recipient = Recipient.query.get(rid)
-    if not campaign or not recipient:
+    # Duplicate reports are ignored by the unique index. When written
+    # synchronously and nothing was inserted, spend a query telling
+    # "repeat" from "forged ids"; buffered writes can't tell, so no 404.
+    inserted = track_event(cid, rid, "reported", _client_ip())
+    if inserted is False and not ids_exist(cid, rid):
         return abort(404)
 
-    ip = request.headers.get("X-Forwarded-For", request.remote_addr)
-    if ip and "," in ip:
-        ip = ip.split(",")[0].strip()
+    return _reported_popup()
 
-    # Avoid duplicate reports
-    already = Event.query.filter_by(
-        campaign_id=cid, recipient_id=rid, event_type="reported"
-    ).first()
-    if not already:
-        db.session.add(Event(campaign_id=cid, recipient_id=rid, event_type="reported", ip=ip))
-        db.session.commit()
+@bp.route("/r/<token>", methods=["GET"])
+def track_report_token(token: str):
+    """Signed-link version of track_report: no lookups, the signature is the check."""
+    ids = read_token(token)
+    if ids is None:
+        return abort(404)
+    cid, rid, _ = ids
+
+    track_event(cid, rid, "reported", _client_ip())
+    return _reported_popup()
 
+def _reported_popup():
     # Popup message
     html = """<!doctype html>
     <meta charset="utf-8">
@@ -280,39 +342,47 @@ def feedback():
     # Determine which phishing template was used, based on subject
     template_key = SUBJECT_TO_TEMPLATE.get(campaign.subject)
 
-    # Choose the correct feedback page
-    if template_key and template_key in FEEDBACK_TEMPLATES:
-        feedback_template = FEEDBACK_TEMPLATES[template_key]
-    else:
-        # If subject doesn't match anything → send generic feedback
-        feedback_template = "feedback.html"
-
     return render_template(
-        feedback_template,
+        _feedback_template(template_key),
         title="Phishing Simulation Feedback",
         campaign=campaign,
         recipient=recipient,
     )
 
 
+@bp.route("/feedback/<token>", methods=["GET"])
+def feedback_token(token: str):
+    """Feedback page for a signed link: the template key rides in the token, so no queries."""
+    ids = read_token(token)
+    if ids is None:
+        abort(404)
+
+    return render_template(
+        _feedback_template(ids[2]),
+        title="Phishing Simulation Feedback",
+        campaign=None,
+        recipient=None,
+    )
+
+
+def _feedback_template(template_key):
+    # Choose the correct feedback page
+    if template_key and template_key in FEEDBACK_TEMPLATES:
+        return FEEDBACK_TEMPLATES[template_key]
+    # If the template is unknown → send generic feedback
+    return "feedback.html"
+
+
 
 @bp.route("/feedback/report", methods=["POST"])
 def feedback_report():
 	"""Record a 'reported' event for the campaign/recipient."""
 	cid = request.form.get("cid", type=int)
-	rid = request.form.get("rid", type-int)
-
-	ip = request.headers.get("X-Forwarded-For", request.remote_addr)
-	if ip and "," in ip:
-		ip = ip.split(",")[0].strip()
+	rid = request.form.get("rid", type=int)
 
-	# Only log if we have both IDs and they exist
+	# Only log if we have both IDs (unknown ids and repeats are ignored)
 	if cid and rid:
-		if Campaign.query.get(cid) and Recipient.query.get(rid):
-			exists = Event.query.filter_by(campaign_id=cid, recipient_id=rid, event_type="reported").first()
-		if not exists:
-			db.session.add(Event(campaign_id=cid, recipient_id=rid, event_type="reported", ip=ip))
-			db.session.commit()
+		track_event(cid, rid, "reported", _client_ip())
 
 	# Re-render page with a success banner
 	campaign = Campaign.query.get(cid) if cid else None
@@ -326,109 +396,178 @@ def thankyou(cid: int, rid: int):
 	if not campaign or not recipient:
 		return abort(404)
 	return render_template("thankyou.html", title="Reported", campaign=campaign, recipient=recipient)
+
+@bp.route("/thankyou/<token>")
+def thankyou_token(token: str):
+	if read_token(token) is None:
+		return abort(404)
+	return render_template("thankyou.html", title="Reported", campaign=None, recipient=None)
 	
+# Events per page on /results, and the most /api/events returns at once
+RESULTS_PAGE_SIZE = 50
+API_EVENTS_MAX_LIMIT = 500
+
 @bp.route("/results", methods=["GET"])
 def results():
     """
-    List campaign events with optional filter by campaign_id.
+    List campaign events, newest first, a page at a time, with optional
+    filters (campaign, event type, department, date range).
     Show summary: delivered, clicked, reported totals.
     """
-    # Dropdown options
-    campaigns = Campaign.query.order_by(Campaign.id.desc()).all()
-
-    # Filter (campaign_id from query string, e.g. /results?campaign_id=3)
-    campaign_id = request.args.get("campaign_id", type=int)
-
-    # ---- Base query for the table (JOINs so we can show campaign name & recipient email)
-    query = (
-        Event.query
-        .join(Campaign, Campaign.id == Event.campaign_id)
-        .join(Recipient, Recipient.id == Event.recipient_id)
-        .add_columns(
-            Event.id.label("event_id"),
-            Event.event_type,
-            Event.ip,
-            Event.ts,
-            Campaign.id.label("cid"),
-            Campaign.name.label("campaign_name"),
-            Recipient.id.label("recipient_id"),
-            Recipient.email.label("recipient_email"),
-        )
-    )
+    filters = queries.filters_from_args(request.args)
+    before = request.args.get("before", type=int)
+    after = request.args.get("after", type=int)
 
-    # Only show CLICKED + REPORTED events in the bottom table
-    query = query.filter(Event.event_type.in_(["clicked", "reported"]))
+    # ---- One page of the table (JOINs so we can show campaign name & recipient email);
+    # CLICKED + REPORTED events unless another type is picked
+    events, older, newer = queries.page_of_events(filters, before=before, after=after, limit=RESULTS_PAGE_SIZE)
 
-    if campaign_id:
-        query = query.filter(Event.campaign_id == campaign_id)
-
-    events = query.order_by(Event.id.desc()).all()
-
-    # ---- Summary stats (these still look at ALL events, including delivered)
-    base_count = db.session.query(func.count(Event.id))
-
-    if campaign_id:
-        base_count = base_count.filter(Event.campaign_id == campaign_id)
-
-    total_delivered = base_count.filter(Event.event_type == "delivered").scalar()
-    total_clicked   = base_count.filter(Event.event_type == "clicked").scalar()
-    total_reported  = base_count.filter(Event.event_type == "reported").scalar()
+    # ---- Summary stats (all event types, including delivered) from the rollup table
+    total_delivered, total_clicked, total_reported = stats.totals(filters["campaign_id"])
 
     return render_template(
         "results.html",
         title="Results",
-        campaigns=campaigns,
-        campaign_id=campaign_id,
+        campaigns=queries.campaign_options(),
+        departments=queries.department_options(),
+        event_types=queries.EVENT_TYPES,
+        campaign_id=filters["campaign_id"],
+        event_type=filters["event_type"] or "",
+        department_id=filters["department_id"],
+        start=request.args.get("start", "") if filters["start"] else "",
+        end=request.args.get("end", "") if filters["end"] else "",
+        filter_args=queries.filter_args(filters),
         events=events,
+        older_cursor=older,
+        newer_cursor=newer,
+        # Live updates only make sense on the newest page, and only the
+        # campaign/event-type filters can be applied to pushed events
+        live_updates=not (before or after or filters["department_id"] or filters["start"] or filters["end"]),
         total_delivered=total_delivered or 0,
         total_clicked=total_clicked or 0,
         total_reported=total_reported or 0,
     )
 
 
-@bp.route("/results.csv", methods=["GET"])
-def results_csv():
+@bp.route("/api/events", methods=["GET"])
+@login_required
+def api_events():
     """
-    Download events as CSV; supports ?campaign_id=<id> filter (same as /results).
+    Events as JSON, newest first, with the /results filters.
+    Page with ?before=<next_cursor> (older) or ?after=<prev_cursor> (newer);
+    ?limit= sets the page size (default 100, at most API_EVENTS_MAX_LIMIT).
+    Without ?event_type every event type is included.
     """
-    import csv, io
-
-    campaign_id = request.args.get("campaign_id", type=int)
-
-    query = (
-        Event.query
-        .join(Campaign, Campaign.id == Event.campaign_id)
-        .join(Recipient, Recipient.id == Event.recipient_id)
-        .add_columns(
-            Event.id.label("event_id"),
-            Campaign.id.label("cid"),
-            Campaign.name.label("campaign_name"),
-            Recipient.email.label("recipient_email"),      
-            Event.event_type,
-            Event.ip,
-            Event.ts,
-        )
+    filters = queries.filters_from_args(request.args)
+    limit = min(max(request.args.get("limit", 100, type=int), 1), API_EVENTS_MAX_LIMIT)
+    rows, older, newer = queries.page_of_events(
+        filters,
+        before=request.args.get("before", type=int),
+        after=request.args.get("after", type=int),
+        limit=limit,
+        default_types=None,
+    )
+    return jsonify(
+        events=[
+            {
+                "id": r.event_id,
+                "campaign_id": r.cid,
+                "campaign_name": r.campaign_name,
+                "recipient_id": r.recipient_id,
+                "recipient_email": r.recipient_email,
+                "event_type": r.event_type,
+                "ip": r.ip,
+                "ts": r.ts.isoformat() if r.ts else None,
+            }
+            for r in rows
+        ],
+        next_cursor=older,
+        prev_cursor=newer,
     )
-    if campaign_id:
-        query = query.filter(Event.campaign_id == campaign_id)
 
-    rows = query.order_by(Event.id.desc()).all()
 
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["event_id", "campaign_id", "campaign_name", "recipient_email", "event_type", "ip", "timestamp"])
+# Rows fetched per query while streaming /results.csv
+CSV_EXPORT_BATCH = 1000
 
-    for r in rows:
-        writer.writerow([r.event_id, r.cid, r.campaign_name, r.recipient_email, r.event_type, r.ip or "", r.ts])
+@bp.route("/results.csv", methods=["GET"])
+def results_csv():
+    """
+    Download events as CSV; supports the same filters as /results
+    (campaign_id, event_type, department_id, start, end); every event type
+    is included unless one is picked.
+    Rows are streamed as they are read, so memory use doesn't grow with the
+    export; add ?gzip=1 to get a gzip-compressed .csv.gz instead.
+    """
+    import zlib
+
+    filters = queries.filters_from_args(request.args)
+    compress = request.args.get("gzip") in ("1", "true", "yes")
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["event_id", "campaign_id", "campaign_name", "recipient_email", "event_type", "ip", "timestamp"])
+
+        for n, r in enumerate(queries.iter_events(filters, batch_size=CSV_EXPORT_BATCH, default_types=None), 1):
+            writer.writerow([r.event_id, r.cid, r.campaign_name, r.recipient_email, r.event_type, r.ip or "", r.ts])
+            # Hand the text over every few hundred rows
+            if n % 500 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def gzipped(chunks):
+        gz = zlib.compressobj(wbits=31)  # 31 = gzip container
+        for chunk in chunks:
+            data = gz.compress(chunk.encode("utf-8"))
+            if data:
+                yield data
+        yield gz.flush()
+
+    filename = "clicksafe_events.csv.gz" if compress else "clicksafe_events.csv"
+    return Response(
+        stream_with_context(gzipped(generate()) if compress else generate()),
+        mimetype="application/gzip" if compress else "text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
-    csv_bytes = output.getvalue()
-    output.close()
+@bp.route("/export/events", methods=["GET"])
+@login_required
+def export_events():
+    """
+    Download events (with campaign, recipient and department columns) as
+    ?format=parquet (default) or ?format=arrow. ?since_id=N exports only
+    events with a higher id; the X-Last-Event-Id response header is the
+    since_id to use next time. ?campaign_id= narrows it to one campaign.
+    """
+    import tempfile
 
-    return Response(
-        csv_bytes,
-        mimetype="text/csv",
-        headers={"Content-Disposition": "attachment; filename=clicksafe_events.csv"}
+    fmt = request.args.get("format", "parquet")
+    if fmt not in export.FORMATS:
+        abort(400, description=f"format must be one of: {', '.join(export.FORMATS)}")
+    since_id = request.args.get("since_id", 0, type=int)
+
+    # Spool to a temp file: the writers need a real file for the footer,
+    # and memory stays bounded by one batch either way
+    spool = tempfile.TemporaryFile()
+    try:
+        _, last_id = export.write_events(
+            spool, fmt, since_id=since_id, campaign_id=request.args.get("campaign_id", type=int)
+        )
+    except RuntimeError as e:  # pyarrow not installed
+        spool.close()
+        abort(501, description=str(e))
+    spool.seek(0)
+
+    response = send_file(
+        spool,
+        mimetype="application/vnd.apache.parquet" if fmt == "parquet" else "application/vnd.apache.arrow.file",
+        as_attachment=True,
+        download_name=f"clicksafe_events{export.FORMATS[fmt]}",
     )
+    response.headers["X-Last-Event-Id"] = str(last_id)
+    return response
 
 @bp.post("/results/delete")
 def delete_campaigns():
@@ -445,15 +584,31 @@ def delete_campaigns():
         if "ALL" in ids:
             # delete all events first (avoid FK constraint), then campaigns
             Event.query.delete(synchronize_session=False)
+            CampaignStats.query.delete(synchronize_session=False)
+            EventBucket.query.delete(synchronize_session=False)
+            CampaignRecipient.query.delete(synchronize_session=False)
+            SendBatch.query.delete(synchronize_session=False)
+            SendJob.query.delete(synchronize_session=False)
             Campaign.query.delete(synchronize_session=False)
         else:
             int_ids = [int(x) for x in ids if x.isdigit()]
             if int_ids:
                 Event.query.filter(Event.campaign_id.in_(int_ids)) \
                            .delete(synchronize_session=False)
+                CampaignStats.query.filter(CampaignStats.campaign_id.in_(int_ids)) \
+                                   .delete(synchronize_session=False)
+                EventBucket.query.filter(EventBucket.campaign_id.in_(int_ids)) \
+                                 .delete(synchronize_session=False)
+                CampaignRecipient.query.filter(CampaignRecipient.campaign_id.in_(int_ids)) \
+                                       .delete(synchronize_session=False)
+                SendBatch.query.filter(SendBatch.campaign_id.in_(int_ids)) \
+                               .delete(synchronize_session=False)
+                SendJob.query.filter(SendJob.campaign_id.in_(int_ids)) \
+                             .delete(synchronize_session=False)
                 Campaign.query.filter(Campaign.id.in_(int_ids)) \
                               .delete(synchronize_session=False)
         db.session.commit()
+        stats.dashboard_cache.invalidate()
         flash("Campaign(s) deleted successfully.", "success")
     except Exception as e:
         db.session.rollback()
@@ -482,81 +637,38 @@ def manage_departments():
                 flash("That department already exists.", "warning")
             else:
                 db.session.add(Department(name=name))
+                roster.mark_changed()
                 db.session.commit()
                 flash(f"Department '{name}' added.", "success")
         else:
             flash("Department name cannot be empty.", "danger")
         return redirect(url_for("main.manage_departments"))
 
-    # For GET: load departments and recipient counts
-    departments = Department.query.order_by(Department.name.asc()).all()
-    recipient_counts = {
-        d.id: Recipient.query.filter_by(department_id=d.id).count()
-        for d in departments
-    }
-
+    # For GET: departments and recipient counts, one grouped query (cached)
     return render_template(
         "departments.html",
         title="Manage Departments",
-        departments=departments,
-        recipient_counts=recipient_counts,
+        departments=roster.departments(),
     )
 
 	
+RECIPIENTS_PAGE_SIZE = 50
+TYPEAHEAD_MAX_LIMIT = 25
+
 @bp.route("/departments/<int:dept_id>/recipients", methods=["GET", "POST"])
 def manage_department_recipients(dept_id):
     department = Department.query.get_or_404(dept_id)
 
     if request.method == "POST":
      
-        # 1) CSV UPLOAD: bulk add recipients (Name + Email only)
-        upload_file = request.files.get("upload_file")
+        # 1) CSV UPLOAD: bulk add recipients (Name + Email only). The file is
+        # spooled to disk and imported in the background (see importer.py)
+        upload_file = request.files.get("csv_file") or request.files.get("upload_file")
         if upload_file and upload_file.filename:
-            added = 0
-
-            def add_recipient_from_row(name_val: str, email_val: str):
-                nonlocal added
-                name_val = (name_val or "").strip()
-                email_val = (email_val or "").strip()
-
-                # Skip completely empty lines
-                if not email_val:
-                    return
-
-                # Skip header-like row (e.g., "email" without @)
-                if "email" in email_val.lower() and "@" not in email_val:
-                    return
-
-                # Look up by email; create if needed
-                existing = Recipient.query.filter_by(email=email_val).first()
-                if existing is None:
-                    existing = Recipient(name=name_val or None, email=email_val)
-                    db.session.add(existing)
-                    db.session.flush()  # ensure existing.id is set
-
-                # Attach to department if not already linked
-                if existing not in department.recipients:
-                    department.recipients.append(existing)
-                    added += 1
-
-            # Read CSV as UTF-8 (handles BOM with utf-8-sig)
-            stream = io.StringIO(
-                upload_file.stream.read().decode("utf-8-sig"),
-                newline=""
-            )
-            reader = csv.reader(stream)
-
-            for row in reader:
-                if not row:
-                    continue
-                # Expecting: [Name, Email]
-                name_val = row[0] if len(row) > 0 else ""
-                email_val = row[1] if len(row) > 1 else ""
-                add_recipient_from_row(name_val, email_val)
-
+            job = importer.create_import_job(department.id, upload_file)
             db.session.commit()
-            flash(f"Imported {added} recipient(s) into {department.name}.", "success")
-            return redirect(url_for("main.manage_department_recipients", dept_id=dept_id))
+            jobs.submit(current_app._get_current_object(), importer.run_import_job, job.id, pool="import")
+            return redirect(url_for("main.import_status", job_id=job.id))
 
         
         # 2) SINGLE RECIPIENT ADD
@@ -565,7 +677,7 @@ def manage_department_recipients(dept_id):
         email = request.form.get("email", "").strip()
 
         if email:
-            recipient = Recipient.query.filter_by(email=email).first()
+            recipient = Recipient.query.filter_by(email_lower=email.lower()).first()
             if recipient is None:
                 recipient = Recipient(name=name, email=email)
                 db.session.add(recipient)
@@ -573,6 +685,7 @@ def manage_department_recipients(dept_id):
 
             if recipient not in department.recipients:
                 department.recipients.append(recipient)
+                roster.mark_changed()
                 db.session.commit()
                 flash("Recipient added.", "success")
             else:
@@ -583,41 +696,127 @@ def manage_department_recipients(dept_id):
         return redirect(url_for("main.manage_department_recipients", dept_id=dept_id))
 
    
-    # GET – show recipients for this department
+    # GET – one page of this department's recipients, by email, optionally
+    # narrowed to an email/name prefix (?q=); keyset-paged like /results
   
-    recipients = (
-        department.recipients.order_by(Recipient.email.asc())
-        if hasattr(department.recipients, "order_by")
-        else sorted(department.recipients, key=lambda r: r.email.lower())
+    q = (request.args.get("q") or "").strip()
+    recipients, prev_cursor, next_cursor = queries.department_recipients_page(
+        dept_id,
+        q=q,
+        before=request.args.get("before", type=int),
+        after=request.args.get("after", type=int),
+        limit=RECIPIENTS_PAGE_SIZE,
     )
 
     return render_template(
         "department_recipients.html",
         department=department,
         recipients=recipients,
+        q=q,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+        other_departments=Department.query.filter(Department.id != dept_id).order_by(Department.name.asc()).all(),
     )
 
 	
+@bp.route("/api/recipients/search", methods=["GET"])
+@login_required
+def api_recipient_search():
+    """
+    Typeahead lookup: recipients whose email or name starts with ?q=,
+    optionally only in ?department_id=; ?limit= up to TYPEAHEAD_MAX_LIMIT.
+    """
+    q = (request.args.get("q") or "").strip()
+    if not q:
+        return jsonify(recipients=[])
+    limit = min(max(request.args.get("limit", 10, type=int), 1), TYPEAHEAD_MAX_LIMIT)
+    rows = queries.typeahead_recipients(q, department_id=request.args.get("department_id", type=int), limit=limit)
+    return jsonify(
+        recipients=[
+            {
+                "id": r.id,
+                "name": r.name,
+                "email": r.email,
+                "department_id": r.department_id,
+                "department_name": r.department_name,
+            }
+            for r in rows
+        ]
+    )
+
 @bp.route("/departments/<int:dept_id>/recipients/<int:rid>/delete", methods=["POST"])
 def delete_department_recipient(dept_id, rid):
-	dept = Department.query.get_or_404(dept_id)
-	r = Recipient.query.get_or_404(rid)
-	if r.department_id == dept.id:
-		db.session.delete(r)
+	Department.query.get_or_404(dept_id)
+	if bulk.delete_recipients(recipient_ids=[rid], department_id=dept_id):
 		db.session.commit()
 		flash("Recipient removed", "success")
 	return redirect(url_for("main.manage_department_recipients", dept_id=dept_id))
 	
 @bp.route("/departments/<int:dept_id>/delete", methods=["POST"])
 def delete_department(dept_id):
-    dept = Department.query.get_or_404(dept_id)
-    # Optional: clear department_id for recipients first
-    for r in dept.recipients:
-        r.department_id = None
-    db.session.delete(dept)
+    Department.query.get_or_404(dept_id)
+    # Recipients stay, without a department (one UPDATE, see bulk.py)
+    detached = bulk.delete_department(dept_id)
     db.session.commit()
-    flash("Department deleted.", "success")
+    flash(f"Department deleted; {detached} recipient(s) now have no department.", "success")
     return redirect(url_for("main.manage_departments"))
+
+@bp.route("/recipients/bulk", methods=["POST"])
+@login_required
+def bulk_recipients():
+    """
+    Move, detach or delete many recipients in one go (see bulk.py).
+
+    Takes a JSON body or a form with:
+      action            "move", "detach" or "delete"
+      recipient_ids     ids (list, or repeated form field)
+      emails            addresses (list, or one per line in a form)
+      department_id     only recipients currently in this department
+      to_department_id  target for "move"
+    At least one recipient id or email is required; an empty selection is
+    rejected (400, or a flash message) rather than applied to anyone.
+    JSON requests get {"action", "affected"} back; form posts are redirected
+    to `next` (or the departments page).
+    """
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        recipient_ids = data.get("recipient_ids") or []
+        emails = data.get("emails") or []
+        department_id = data.get("department_id")
+        to_department_id = data.get("to_department_id")
+    else:
+        data = request.form
+        recipient_ids = request.form.getlist("recipient_ids")
+        emails = (request.form.get("emails") or "").split()
+        department_id = request.form.get("department_id", type=int)
+        to_department_id = request.form.get("to_department_id", type=int)
+
+    action = data.get("action")
+    try:
+        if not recipient_ids and not [e for e in emails if e and e.strip()]:
+            raise ValueError("No recipients selected")
+        affected = bulk.apply(
+            action,
+            recipient_ids=[int(i) for i in recipient_ids],
+            emails=emails,
+            department_id=int(department_id) if department_id not in (None, "") else None,
+            to_department_id=int(to_department_id) if to_department_id not in (None, "") else None,
+        )
+    except (TypeError, ValueError) as e:
+        db.session.rollback()
+        if request.is_json:
+            return jsonify({"error": str(e)}), 400
+        flash(str(e), "danger")
+    else:
+        db.session.commit()
+        if request.is_json:
+            return jsonify({"action": action, "affected": affected})
+        flash(f"{action.capitalize()}: {affected} recipient(s) affected.", "success")
+
+    target = request.form.get("next") or ""
+    if not target.startswith("/") or target.startswith("//"):
+        target = url_for("main.manage_departments")
+    return redirect(target)
     
 @bp.route("/departments/<int:dept_id>/recipients/<int:rid>/edit",
           methods=["GET", "POST"])
@@ -664,126 +863,102 @@ def edit_department_recipient(dept_id: int, rid: int):
 @bp.route("/dashboard", methods=["GET"])
 @login_required
 def dashboard():
-    # 1) Click rate over time (by date)
-    click_rows = (
-        db.session.query(
-            func.date(Event.ts).label("day"),
-            func.count(Event.id).label("clicks"),
-        )
-        .filter(Event.event_type == "clicked")
-        .group_by(func.date(Event.ts))
-        .order_by(func.date(Event.ts))
-        .all()
-    )
-    click_labels = [r.day.strftime("%Y-%m-%d") for r in click_rows]
-    click_values = [r.clicks for r in click_rows]
-
-    # 2) Report rate per campaign (reported vs delivered)
-    delivered_rows = (
-        db.session.query(
-            Campaign.id,
-            Campaign.name,
-            func.count(Event.id).label("delivered"),
-        )
-        .join(Event, Event.campaign_id == Campaign.id)
-        .filter(Event.event_type == "delivered")
-        .group_by(Campaign.id)
-        .all()
-    )
-
-    reported_rows = (
-        db.session.query(
-            Campaign.id,
-            Campaign.name,
-            func.count(Event.id).label("reported"),
-        )
-        .join(Event, Event.campaign_id == Campaign.id)
-        .filter(Event.event_type == "reported")
-        .group_by(Campaign.id)
-        .all()
-    )
-
-    # Map campaign_id -> {name, delivered, reported}
-    camp_stats = {}
-    for row in delivered_rows:
-        camp_stats[row.id] = {
-            "name": row.name,
-            "delivered": row.delivered,
-            "reported": 0,
-        }
-    for row in reported_rows:
-        camp_stats.setdefault(row.id, {"name": row.name, "delivered": 0, "reported": 0})
-        camp_stats[row.id]["reported"] = row.reported
-
-    camp_labels = [v["name"] for v in camp_stats.values()]
-    camp_delivered = [v["delivered"] for v in camp_stats.values()]
-    camp_reported = [v["reported"] for v in camp_stats.values()]
-
-    # 3) Department risk (clicked events by department)
-    dept_rows = (
-        db.session.query(
-            Department.name.label("dept_name"),
-            func.count(Event.id).label("clicks"),
-        )
-        .join(Recipient, Recipient.department_id == Department.id)
-        .join(Event, Event.recipient_id == Recipient.id)
-        .filter(Event.event_type == "clicked")
-        .group_by(Department.id)
-        .order_by(Department.name)
-        .all()
-    )
-    dept_labels = [r.dept_name for r in dept_rows]
-    dept_clicks = [r.clicks for r in dept_rows]
+    # Date range (inclusive days, UTC); defaults to the last 30 days.
+    # Charts read the pre-aggregated event_buckets rows for the range only.
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    end_day = queries.parse_day(request.args.get("end")) or today
+    start_day = queries.parse_day(request.args.get("start")) or end_day - timedelta(days=29)
+    if start_day > end_day:
+        start_day, end_day = end_day, start_day
+    range_end = end_day + timedelta(days=1)
+
+    hourly_enabled = current_app.config.get("EVENT_BUCKET_HOURLY", False)
+    granularity = "hour" if hourly_enabled and request.args.get("granularity") == "hour" else "day"
+
+    # All series in one cached aggregation (see stats.dashboard_data)
+    data = stats.dashboard_data(start_day, range_end, granularity)
+
+    # 1) Click rate over time (per day, or per hour)
+    label_format = "%Y-%m-%d %H:00" if granularity == "hour" else "%Y-%m-%d"
+    click_labels = [ts.strftime(label_format) for ts, *_ in data["series"]]
+    click_values = [clicked for _, _, clicked, _ in data["series"]]
+    report_values = [reported for _, _, _, reported in data["series"]]
+
+    # 2) Report rate per campaign (reported vs delivered), one rollup row per campaign
+    camp_labels = [r.name for r in data["campaigns"]]
+    camp_delivered = [r.delivered for r in data["campaigns"]]
+    camp_reported = [r.reported for r in data["campaigns"]]
+
+    # 3) Department risk (clicked events by department, within the range)
+    dept_labels = [name for name, *_ in data["departments"]]
+    dept_clicks = [clicked for _, _, clicked, _ in data["departments"]]
+
+    # 4) Analytics for campaigns launched in the range: time-to-click,
+    # funnel, department click rates with confidence intervals
+    insights = analytics.cached(start=start_day, end=range_end)
 
     return render_template(
         "dashboard.html",
         title="Dashboard",
         click_labels=click_labels,
         click_values=click_values,
+        report_values=report_values,
         camp_labels=camp_labels,
         camp_delivered=camp_delivered,
         camp_reported=camp_reported,
         dept_labels=dept_labels,
         dept_clicks=dept_clicks,
+        start=start_day.strftime("%Y-%m-%d"),
+        end=end_day.strftime("%Y-%m-%d"),
+        granularity=granularity,
+        hourly_enabled=hourly_enabled,
+        insights=insights,
     )
 
+
+@bp.route("/api/analytics", methods=["GET"])
+@login_required
+def api_analytics():
+    """
+    Campaign analytics as JSON (see analytics.compute). Optional filters:
+    campaign_id, department_id, and start/end (YYYY-MM-DD, inclusive) on
+    the campaigns' launch date.
+    """
+    filters = queries.filters_from_args(request.args)
+    end = filters["end"] + timedelta(days=1) if filters["end"] else None
+    return jsonify(analytics.cached(
+        campaign_id=filters["campaign_id"],
+        department_id=filters["department_id"],
+        start=filters["start"],
+        end=end,
+    ))
+
 @bp.route("/recipients/<int:rid>/history", methods=["GET"])
 @login_required
 def recipient_history(rid: int):
     recipient = Recipient.query.get_or_404(rid)
 
-    # All events for this recipient with campaign info
-    base_query = (
-        db.session.query(
-            Event,
-            Campaign.name.label("campaign_name"),
-        )
-        .join(Campaign, Campaign.id == Event.campaign_id)
-        .filter(Event.recipient_id == rid)
-    )
-    
-    rows_all = base_query.order_by(Event.ts.desc()).all()
-    
-
-    total_clicked = sum(1 for e, _ in rows_all if e.event_type == "clicked")
-    total_reported = sum(1 for e, _ in rows_all if e.event_type == "reported")
-    total_delivered = sum(1 for e, _ in rows_all if e.event_type == "delivered")
+    # Totals, campaigns and event types, aggregated in SQL
+    totals, event_types, campaigns_seen = queries.recipient_summary(rid)
+    total_delivered, total_clicked, total_reported, _ = totals
 
-    campaigns_seen = sorted({campaign_name for _, campaign_name in rows_all})
-    
-    event_types = sorted({e.event_type for e, _ in rows_all})
+    # One page of events (with campaign info), filtered in the query
     selected_type = (request.args.get("event_type") or "").strip()
-    
-    if selected_type:
-    	rows = [row for row in rows_all if row[0].event_type == selected_type]
-    else:
-    	rows = rows_all
+    rows, older, newer = queries.recipient_events_page(
+        rid,
+        event_type=selected_type or None,
+        before=request.args.get("before", type=int),
+        after=request.args.get("after", type=int),
+        limit=RESULTS_PAGE_SIZE,
+    )
 
     return render_template(
         "recipient_history.html",
         title=f"History for {recipient.name or recipient.email}",
         recipient=recipient,
         events=rows,
+        older_cursor=older,
+        newer_cursor=newer,
         total_clicked=total_clicked,
         total_reported=total_reported,
         total_delivered=total_delivered,
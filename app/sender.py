@@ -0,0 +1,444 @@
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from flask import current_app
+from sqlalchemy import and_, func, insert, literal, or_, select, update
+from .db import db, insert_ignore
+from .models import Recipient, Campaign, Event, SendJob, CampaignRecipient, SendBatch
+from .delivery import get_engine
+from .emailer import ROUTES, route_for, prepare_message
+from .render import CompiledEmail
+from .events import now
+from .tokens import make_token
+from . import live, stats
+from .workqueue import plan_batches, claim_batch, renew_lease, next_available_at
+
+# Seconds between lease renewals while a batch is being sent
+HEARTBEAT_EVERY = 30
+
+
+def _random_ipv4():
+    return ".".join(str(random.randint(10, 250)) for _ in range(4))
+
+
+def recipient_slots(campaign, recipient, base_url, template_key):
+    """
+    The per-recipient values the email templates use: the tracking/report
+    links (signed tokens, see tokens.py) plus the realistic-looking decoy
+    fields (date, country, platform, browser, ip).
+    """
+    token = make_token(campaign.id, recipient.id, template_key)
+
+    # Optional realistic fields
+    return dict(
+        tracking_url=f"{base_url}/l/{token}",
+        report_url=f"{base_url}/r/{token}",
+        date=datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S +0000"),
+        country=random.choice(["Russia", "Canada", "USA", "Mexico", "India", "China"]),
+        platform=random.choice(["Windows 10", "Windows 11", "macOS 12"]),
+        browser=random.choice(["Chrome", "Firefox", "Edge"]),
+        ip=_random_ipv4(),
+    )
+
+
+class _CampaignRenderer:
+    """Compiled template + pre-encoded MIME messages for one campaign."""
+
+    def __init__(self, job, campaign):
+        # Plain snapshot of the campaign: this object outlives the session
+        snapshot = SimpleNamespace(**{c.key: getattr(campaign, c.key) for c in Campaign.__table__.columns})
+        tmpl = current_app.jinja_env.get_template(f"email/{job.template_key}.html")
+
+        self.campaign = snapshot
+        self.base_url = job.base_url
+        self.template_key = job.template_key
+        self.email = CompiledEmail(
+            tmpl, snapshot,
+            verify=current_app.config.get("RENDER_VERIFY", "sample"),
+            logger=current_app.logger,
+        )
+        self.messages = {route: prepare_message(route, snapshot.subject) for route in ROUTES}
+
+    def message_for(self, recipient):
+        slots = recipient_slots(self.campaign, recipient, self.base_url, self.template_key)
+        html = self.email.render(slots, recipient)
+        return self.messages[route_for(recipient.email)].build(recipient.email, html)
+
+
+# Recently used campaign renderers, so each template is compiled once per
+# campaign rather than once per batch
+_renderers = {}
+_renderers_lock = threading.Lock()
+
+
+def _renderer_for(job, campaign):
+    with _renderers_lock:
+        renderer = _renderers.get(campaign.id)
+        if renderer is None:
+            if len(_renderers) >= 16:
+                _renderers.clear()
+            renderer = _renderers[campaign.id] = _CampaignRenderer(job, campaign)
+        return renderer
+
+
+def _recipient_filter(department_ids):
+    """department_ids=None means "everyone who belongs to a department"."""
+    if department_ids is None:
+        return Recipient.department_id.isnot(None)
+    return Recipient.department_id.in_(department_ids)
+
+
+def create_send_job(campaign, template_key, base_url, department_ids):
+    """
+    Queue a campaign for delivery.
+
+    Snapshots the targeted recipients into campaign_recipients as 'pending'
+    rows (one INSERT ... SELECT, no rows pulled into Python) and creates the
+    SendJob that tracks the overall progress. The caller commits.
+    """
+    targets = (
+        select(
+            literal(campaign.id),
+            Recipient.id,
+            literal("pending"),
+            literal(0),
+        )
+        .where(_recipient_filter(department_ids))
+    )
+    result = db.session.execute(
+        insert(CampaignRecipient).from_select(
+            ["campaign_id", "recipient_id", "status", "attempts"], targets
+        )
+    )
+
+    job = SendJob(
+        campaign_id=campaign.id,
+        template_key=template_key,
+        base_url=base_url,
+        department_ids=None if department_ids is None else ",".join(map(str, department_ids)),
+        total=result.rowcount,
+    )
+    db.session.add(job)
+    db.session.flush()  # job.id for the batches
+
+    if not plan_batches(job, current_app.config.get("SEND_CHUNK_SIZE", 500)):
+        # Nobody to send to: there will be no batch to finish the job
+        job.status = "done"
+        job.finished_at = datetime.utcnow()
+    return job
+
+
+def _batch_filter(batch):
+    return and_(
+        CampaignRecipient.campaign_id == batch.campaign_id,
+        CampaignRecipient.recipient_id.between(batch.first_recipient_id, batch.last_recipient_id),
+    )
+
+
+def _due_recipients(batch):
+    """
+    The batch's pending recipients that are due for an attempt, as
+    (id, email, name, attempts) rows. A batch holds at most SEND_CHUNK_SIZE
+    recipients, so this is one bounded page.
+    """
+    now = datetime.utcnow()
+    return db.session.execute(
+        select(Recipient.id, Recipient.email, Recipient.name, CampaignRecipient.attempts)
+        .join(CampaignRecipient, CampaignRecipient.recipient_id == Recipient.id)
+        .where(
+            _batch_filter(batch),
+            CampaignRecipient.status == "pending",
+            or_(CampaignRecipient.next_attempt_at.is_(None), CampaignRecipient.next_attempt_at <= now),
+        )
+        .order_by(CampaignRecipient.recipient_id)
+    ).all()
+
+
+def _deliver_chunk(job, campaign, renderer, engine, chunk, heartbeat=None):
+    """
+    Send one chunk and checkpoint the outcome of every recipient in it.
+
+    heartbeat, if given, is called about every HEARTBEAT_EVERY seconds while
+    sends are in flight (used to keep a batch lease alive).
+    """
+    cfg = current_app.config
+    max_attempts = cfg.get("SEND_MAX_ATTEMPTS", 3)
+    backoff = cfg.get("SEND_RETRY_BACKOFF", 30)
+    ids = [r.id for r in chunk]
+
+    # Mark the chunk as in flight before any SMTP traffic, so a crash
+    # mid-chunk can be told apart from "not attempted yet" on resume
+    db.session.execute(
+        update(CampaignRecipient)
+        .where(CampaignRecipient.campaign_id == campaign.id, CampaignRecipient.recipient_id.in_(ids))
+        .values(status="sending")
+    )
+    db.session.commit()
+
+    in_flight = {}  # Future -> recipient row
+    states = []
+    delivered = []
+    failed = 0
+    last_beat = time.monotonic()
+
+    def collect(done):
+        nonlocal failed, last_beat
+        for fut in done:
+            r = in_flight.pop(fut)
+            attempts = r.attempts + 1
+            exc = fut.exception()
+            state = {
+                "campaign_id": campaign.id,
+                "recipient_id": r.id,
+                "attempts": attempts,
+                "status": "sent",
+                "delivered_at": None,
+                "next_attempt_at": None,
+                "last_error": None,
+            }
+            if exc is None:
+                state["delivered_at"] = now()
+                delivered.append(
+                    {"campaign_id": campaign.id, "recipient_id": r.id, "event_type": "delivered",
+                     "ts": state["delivered_at"]}
+                )
+            else:
+                current_app.logger.error(
+                    "Send to %s failed (campaign %s, attempt %s): %s", r.email, campaign.id, attempts, exc
+                )
+                state["last_error"] = str(exc)[:255]
+                if attempts >= max_attempts:
+                    state["status"] = "failed"
+                    failed += 1
+                else:
+                    # Exponential backoff: backoff, 2*backoff, 4*backoff, ...
+                    state["status"] = "pending"
+                    state["next_attempt_at"] = datetime.utcnow() + timedelta(
+                        seconds=backoff * 2 ** (attempts - 1)
+                    )
+            states.append(state)
+
+        if heartbeat is not None and time.monotonic() - last_beat >= HEARTBEAT_EVERY:
+            heartbeat()
+            last_beat = time.monotonic()
+
+    for r in chunk:
+        in_flight[engine.submit_message(r.email, renderer.message_for(r))] = r
+
+        if len(in_flight) >= engine.max_in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    done, _ = wait(in_flight)
+    collect(done)
+
+    # Checkpoint: recipient states, 'delivered' events and job counters are
+    # committed together, once per chunk. Counters are bumped in SQL because
+    # other workers may be sending other batches of the same job.
+    db.session.execute(update(CampaignRecipient), states)
+    sent = len(delivered)
+    if delivered:
+        # A recipient re-sent after a crash may already have its row; leave
+        # those out so only new events are counted into the rollups
+        already = set(db.session.scalars(
+            select(Event.recipient_id).where(
+                Event.campaign_id == campaign.id,
+                Event.event_type == "delivered",
+                Event.recipient_id.in_([d["recipient_id"] for d in delivered]),
+            )
+        ))
+        delivered = [d for d in delivered if d["recipient_id"] not in already]
+    if delivered:
+        # Delivery state lives in campaign_recipients (above); the events
+        # row is kept for the audit log, which the results/API/CSV listings,
+        # the Parquet export, recipient history and the stats rebuilds read
+        db.session.execute(insert_ignore(Event.__table__), delivered)
+        stats.record((campaign.id, d["recipient_id"], "delivered", d["ts"]) for d in delivered)
+    db.session.execute(
+        update(SendJob)
+        .where(SendJob.id == job.id)
+        .values(sent=SendJob.sent + sent, failed=SendJob.failed + failed)
+    )
+    live.queue_progress(db.session)
+    db.session.commit()
+
+
+def process_batch(batch):
+    """
+    Deliver one claimed batch, then either mark it done or put it back on
+    the queue for when its next retry is due.
+    """
+    cfg = current_app.config
+    lease_seconds = cfg.get("SEND_BATCH_LEASE", 900)
+    job = db.session.get(SendJob, batch.job_id)
+    campaign = db.session.get(Campaign, batch.campaign_id)
+
+    db.session.execute(
+        update(SendJob)
+        .where(SendJob.id == job.id, SendJob.status == "queued")
+        .values(status="running", started_at=datetime.utcnow(), error=None)
+    )
+
+    # A previous claim died mid-chunk: we can't know whether those emails
+    # left, so fail them rather than risk mailing anyone twice
+    stuck = db.session.execute(
+        update(CampaignRecipient)
+        .where(_batch_filter(batch), CampaignRecipient.status == "sending")
+        .values(status="failed", last_error="Interrupted while sending; not retried to avoid a duplicate email")
+    ).rowcount
+    if stuck:
+        db.session.execute(update(SendJob).where(SendJob.id == job.id).values(failed=SendJob.failed + stuck))
+    live.queue_progress(db.session)
+    db.session.commit()
+
+    try:
+        # Rendering and DB writes stay on this thread; the engine's per-route
+        # workers only do the SMTP round-trips.
+        chunk = _due_recipients(batch)
+        if chunk:
+            _deliver_chunk(job, campaign, _renderer_for(job, campaign), get_engine(current_app), chunk,
+                           heartbeat=lambda: renew_lease(batch, lease_seconds))
+
+        # Anything left is waiting for a retry: requeue the batch for then
+        remaining, next_due = db.session.execute(
+            select(func.count(), func.min(CampaignRecipient.next_attempt_at))
+            .join(Recipient, Recipient.id == CampaignRecipient.recipient_id)
+            .where(_batch_filter(batch), CampaignRecipient.status == "pending")
+        ).one()
+        if remaining:
+            batch.status = "queued"
+            batch.available_at = next_due or datetime.utcnow()
+        else:
+            batch.status = "done"
+        batch.claimed_by = None
+        batch.lease_expires_at = None
+        db.session.commit()
+    except Exception as e:
+        # Hand the batch back and park the job until an admin resumes it
+        db.session.rollback()
+        batch.status = "queued"
+        batch.claimed_by = None
+        batch.lease_expires_at = None
+        job.status = "failed"
+        job.error = str(e)
+        job.finished_at = datetime.utcnow()
+        live.queue_progress(db.session)
+        db.session.commit()
+        raise
+
+    _finish_job_if_complete(job.id)
+
+
+def _finish_job_if_complete(job_id):
+    """Mark a live job done once none of its batches is left; returns whether it was."""
+    open_batches = select(SendBatch.id).where(SendBatch.job_id == job_id, SendBatch.status != "done").exists()
+    finished = db.session.execute(
+        update(SendJob)
+        .where(SendJob.id == job_id, SendJob.status.in_(("queued", "running")), ~open_batches)
+        .values(status="done", finished_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if finished:
+        live.queue_progress(db.session)
+    db.session.commit()
+    return bool(finished)
+
+
+def worker_name(suffix=""):
+    return f"{socket.gethostname()}:{os.getpid()}{suffix}"
+
+
+def run_worker(worker_id, job_id=None, poll_interval=2.0, stop_when_idle=False):
+    """
+    Claim and deliver batches until told to stop.
+
+    - job_id: only work on that job, and return once it is no longer live
+    - stop_when_idle: return when no batch is queued or claimed anywhere
+    Otherwise runs forever (the worker.py process).
+    """
+    lease_seconds = current_app.config.get("SEND_BATCH_LEASE", 900)
+
+    while True:
+        batch = claim_batch(worker_id, lease_seconds, job_id)
+        if batch is not None:
+            try:
+                process_batch(batch)
+            except Exception:
+                current_app.logger.exception("Batch %s (campaign %s) failed", batch.id, batch.campaign_id)
+            continue
+
+        if job_id is not None:
+            status = db.session.scalar(select(SendJob.status).where(SendJob.id == job_id))
+            if status not in ("queued", "running"):
+                return
+            # A live job with every batch done (or none at all) is finished
+            if _finish_job_if_complete(job_id):
+                return
+        elif stop_when_idle:
+            busy = db.session.scalar(
+                select(func.count(SendBatch.id))
+                .where(SendBatch.status != "done",
+                       SendBatch.job_id.in_(select(SendJob.id).where(SendJob.status.in_(("queued", "running")))))
+            )
+            if not busy:
+                return
+        db.session.commit()
+
+        # Nothing claimable now: wait for the next retry to come due, or poll
+        due = next_available_at(job_id)
+        delay = poll_interval
+        if due is not None:
+            delay = min(max((due - datetime.utcnow()).total_seconds(), 0.1), poll_interval)
+        time.sleep(delay)
+
+
+# Jobs being driven by a thread in this process (guards against double-resume)
+_active_jobs = set()
+_active_lock = threading.Lock()
+
+
+def run_send_job(job_id: int):
+    """
+    Deliver a queued campaign from inside this process (SEND_QUEUE_BACKEND
+    "thread"): work through the job's batches until none are left.
+
+    Runs on a background thread (see jobs.submit). Each batch's sends are
+    fanned out to the delivery engine and its results checkpointed in
+    campaign_recipients. Failed sends are retried with exponential backoff
+    up to SEND_MAX_ATTEMPTS. Running it again for an interrupted job resumes
+    where it stopped; recipients already sent are never mailed twice.
+    worker.py processes can work on the same job at the same time.
+    """
+    with _active_lock:
+        if job_id in _active_jobs:
+            return
+        _active_jobs.add(job_id)
+
+    try:
+        run_worker(worker_name(f":job{job_id}"), job_id=job_id,
+                   poll_interval=current_app.config.get("SEND_WORKER_POLL", 2.0))
+    finally:
+        with _active_lock:
+            _active_jobs.discard(job_id)
+
+
+def resume_interrupted_jobs():
+    """
+    Run (in the foreground) every job left 'queued' or 'running' by a worker
+    that stopped, e.g. after a restart. Call inside an app context.
+
+    Batches still leased to the dead worker are picked up once their lease
+    (SEND_BATCH_LEASE) runs out.
+    """
+    job_ids = [
+        job_id for (job_id,) in
+        db.session.query(SendJob.id).filter(SendJob.status.in_(("queued", "running"))).order_by(SendJob.id)
+    ]
+    for job_id in job_ids:
+        run_send_job(job_id)
+    return job_ids
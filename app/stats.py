@@ -0,0 +1,274 @@
+from collections import Counter
+from datetime import timedelta
+from flask import current_app
+from sqlalchemy import case, delete, event, func, insert, literal, select, update
+from sqlalchemy.orm import Session
+from .cache import TTLCache
+from .db import db, insert_ignore, truncate_datetime
+from .models import Campaign, CampaignStats, Department, Event, EventBucket, Recipient
+
+# --- Event rollups --- #
+# Two summaries of the events table, both kept up to date by whoever inserts
+# events (record() runs in the same transaction, so the totals move or roll
+# back together with the rows they count):
+# - campaign_stats: one row of totals per campaign (results page, dashboard)
+# - event_buckets:  counts per day (and optionally hour), campaign,
+#                   department and event type (dashboard time series)
+# rebuild() / rebuild_buckets() recount them from events for backfilling.
+
+# Event types with a counter column in campaign_stats
+COUNTED_TYPES = ("delivered", "clicked", "reported")
+
+
+def granularities():
+    """Bucket sizes being maintained: always 'day', plus 'hour' if EVENT_BUCKET_HOURLY."""
+    return ("day", "hour") if current_app.config.get("EVENT_BUCKET_HOURLY") else ("day",)
+
+
+def bucket_start(ts, granularity):
+    """Start of the day/hour containing `ts`."""
+    ts = ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0) if granularity == "day" else ts
+
+
+def record(new_events):
+    """
+    Count freshly inserted events, given as (campaign_id, recipient_id,
+    event_type, ts) tuples, into both rollups. Runs in the caller's
+    transaction (no commit).
+    """
+    new_events = list(new_events)
+    if not new_events:
+        return
+
+    # Bucket by the department the recipient is in when the event arrives
+    recipient_ids = {rid for _, rid, _, _ in new_events}
+    departments = dict(db.session.execute(
+        select(Recipient.id, Recipient.department_id).where(Recipient.id.in_(recipient_ids))
+    ).all())
+
+    counts = Counter()
+    buckets = Counter()
+    sizes = granularities()
+    for cid, rid, event_type, ts in new_events:
+        counts[(cid, event_type)] += 1
+        for granularity in sizes:
+            key = (granularity, bucket_start(ts, granularity), cid, departments.get(rid) or 0, event_type)
+            buckets[key] += 1
+
+    bump(counts)
+    _bump_buckets(buckets)
+    db.session.info["stats_changed"] = True
+
+
+def bump(counts):
+    """
+    Add to the campaign totals. `counts` maps (campaign_id, event_type) ->
+    number of events just inserted; event types without a column are ignored.
+    """
+    per_campaign = {}
+    for (cid, event_type), n in counts.items():
+        if n and event_type in COUNTED_TYPES:
+            per_campaign.setdefault(cid, Counter())[event_type] += n
+    if not per_campaign:
+        return
+
+    # Make sure every campaign has a row, then increment in SQL so
+    # concurrent writers add up instead of overwriting each other
+    db.session.execute(
+        insert_ignore(CampaignStats.__table__),
+        [{"campaign_id": cid, "delivered": 0, "clicked": 0, "reported": 0} for cid in per_campaign],
+    )
+    for cid, added in sorted(per_campaign.items()):
+        db.session.execute(
+            update(CampaignStats)
+            .where(CampaignStats.campaign_id == cid)
+            .values({getattr(CampaignStats, t): getattr(CampaignStats, t) + n for t, n in added.items()})
+        )
+
+
+def _bump_buckets(buckets):
+    """Add to event_buckets; `buckets` maps primary key tuple -> number of events."""
+    if not buckets:
+        return
+    keys = sorted(buckets)
+    db.session.execute(
+        insert_ignore(EventBucket.__table__),
+        [
+            dict(granularity=g, bucket_start=start, campaign_id=cid, department_id=dept, event_type=t, count=0)
+            for g, start, cid, dept, t in keys
+        ],
+    )
+    for key in keys:
+        g, start, cid, dept, t = key
+        db.session.execute(
+            update(EventBucket)
+            .where(
+                EventBucket.granularity == g,
+                EventBucket.bucket_start == start,
+                EventBucket.campaign_id == cid,
+                EventBucket.department_id == dept,
+                EventBucket.event_type == t,
+            )
+            .values(count=EventBucket.count + buckets[key])
+        )
+
+
+def totals(campaign_id=None):
+    """(delivered, clicked, reported) for one campaign, or summed over all of them."""
+    query = select(
+        func.coalesce(func.sum(CampaignStats.delivered), 0),
+        func.coalesce(func.sum(CampaignStats.clicked), 0),
+        func.coalesce(func.sum(CampaignStats.reported), 0),
+    )
+    if campaign_id:
+        query = query.where(CampaignStats.campaign_id == campaign_id)
+    return tuple(db.session.execute(query).one())
+
+
+def per_campaign():
+    """Rows of (id, name, delivered, clicked, reported), one per campaign with any events."""
+    return db.session.execute(
+        select(
+            Campaign.id,
+            Campaign.name,
+            CampaignStats.delivered,
+            CampaignStats.clicked,
+            CampaignStats.reported,
+        )
+        .join(CampaignStats, CampaignStats.campaign_id == Campaign.id)
+        .order_by(Campaign.id)
+    ).all()
+
+
+# Dashboard aggregates, keyed by (start, end, granularity). Cleared after any
+# commit that counted new events (see _invalidate_after_commit), so the TTL
+# only matters for events written by other processes (e.g. send workers).
+dashboard_cache = TTLCache()
+
+
+def dashboard_data(start, end, granularity="day"):
+    """
+    Everything the dashboard charts need for buckets in [start, end), cached:
+    - series:      [(bucket_start, delivered, clicked, reported)] for every
+                   bucket in the range, zeros included
+    - departments: [(department name, delivered, clicked, reported)] by name,
+                   departments with no events in the range left out
+    - campaigns:   per_campaign() rows (all-time totals)
+    """
+    dashboard_cache.ttl = current_app.config.get("DASHBOARD_CACHE_TTL", 30)
+    return dashboard_cache.get(
+        (start, end, granularity),
+        lambda: _compute_dashboard(start, end, granularity),
+    )
+
+
+def _compute_dashboard(start, end, granularity):
+    # One pass over the range's buckets: a column per event type
+    # (conditional aggregation), a row per (bucket, department)
+    sums = [func.sum(case((EventBucket.event_type == t, EventBucket.count), else_=0)) for t in COUNTED_TYPES]
+    rows = db.session.execute(
+        select(EventBucket.bucket_start, Department.name, *sums)
+        .outerjoin(Department, Department.id == EventBucket.department_id)
+        .where(
+            EventBucket.granularity == granularity,
+            EventBucket.event_type.in_(COUNTED_TYPES),
+            EventBucket.bucket_start >= start,
+            EventBucket.bucket_start < end,
+        )
+        .group_by(EventBucket.bucket_start, Department.id, Department.name)
+    ).all()
+
+    per_bucket = {}
+    per_department = {}
+    for ts, department, *counts in rows:
+        counts = [int(n or 0) for n in counts]
+        per_bucket[ts] = [a + b for a, b in zip(per_bucket.get(ts, (0, 0, 0)), counts)]
+        if department is not None:
+            per_department[department] = [a + b for a, b in zip(per_department.get(department, (0, 0, 0)), counts)]
+
+    step = timedelta(days=1) if granularity == "day" else timedelta(hours=1)
+    series = []
+    ts = bucket_start(start, granularity)
+    while ts < end:
+        series.append((ts, *per_bucket.get(ts, (0, 0, 0))))
+        ts += step
+
+    return dict(
+        series=series,
+        departments=[(name, *per_department[name]) for name in sorted(per_department)],
+        campaigns=per_campaign(),
+    )
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    if session.info.pop("stats_changed", False):
+        dashboard_cache.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_after_rollback(session):
+    session.info.pop("stats_changed", None)
+
+
+def rebuild(campaign_ids=None):
+    """
+    Recount campaign_stats from the events table (all campaigns, or just
+    `campaign_ids`) in one transaction. Returns the number of rows written.
+    """
+    removal = delete(CampaignStats)
+    source = select(
+        Event.campaign_id,
+        *[func.sum(case((Event.event_type == t, 1), else_=0)) for t in COUNTED_TYPES],
+    ).group_by(Event.campaign_id)
+    if campaign_ids:
+        removal = removal.where(CampaignStats.campaign_id.in_(campaign_ids))
+        source = source.where(Event.campaign_id.in_(campaign_ids))
+
+    db.session.execute(removal)
+    written = db.session.execute(
+        insert(CampaignStats.__table__).from_select(["campaign_id", *COUNTED_TYPES], source)
+    ).rowcount
+    db.session.info["stats_changed"] = True
+    db.session.commit()
+    return written
+
+
+def rebuild_buckets(granularity, since=None, until=None):
+    """
+    Re-aggregate event_buckets of one granularity from the events table for
+    buckets starting in [since, until) (either end may be open), in one
+    transaction. Returns the number of bucket rows written.
+
+    Meant for closed buckets: events arriving for a bucket while it is
+    being rebuilt may be counted twice or not at all.
+    """
+    start = truncate_datetime(Event.ts, granularity)
+    department = func.coalesce(Recipient.department_id, 0)
+    source = (
+        select(literal(granularity), start, Event.campaign_id, department, Event.event_type, func.count())
+        .select_from(Event)
+        .join(Recipient, Recipient.id == Event.recipient_id)
+        .group_by(start, Event.campaign_id, department, Event.event_type)
+    )
+    removal = delete(EventBucket).where(EventBucket.granularity == granularity)
+    if since is not None:
+        since = bucket_start(since, granularity)
+        source = source.where(Event.ts >= since)
+        removal = removal.where(EventBucket.bucket_start >= since)
+    if until is not None:
+        until = bucket_start(until, granularity)
+        source = source.where(Event.ts < until)
+        removal = removal.where(EventBucket.bucket_start < until)
+
+    db.session.execute(removal)
+    written = db.session.execute(
+        insert(EventBucket.__table__).from_select(
+            ["granularity", "bucket_start", "campaign_id", "department_id", "event_type", "count"], source
+        )
+    ).rowcount
+    db.session.info["stats_changed"] = True
+    db.session.commit()
+    return written
+
@@ -0,0 +1,54 @@
+import base64
+import hashlib
+import hmac
+from flask import current_app
+
+# --- Signed tracking tokens --- #
+# Tracking links carry "<cid>.<rid>.<template key>" plus an HMAC of it keyed
+# on SECRET_KEY, so a handler can trust the ids (and know which feedback page
+# to show) without looking anything up in the database.
+
+_SALT = b"clicksafe-tracking-link"
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _signature(payload: bytes, secret: str) -> bytes:
+    key = hmac.new(secret.encode("utf-8"), _SALT, hashlib.sha256).digest()
+    return hmac.new(key, payload, hashlib.sha256).digest()[:16]
+
+
+def make_token(cid: int, rid: int, template_key: str, secret: str | None = None) -> str:
+    """URL-safe token for one recipient's links in one campaign."""
+    secret = secret or current_app.config["SECRET_KEY"]
+    payload = f"{cid}.{rid}.{template_key}".encode("utf-8")
+    return f"{_b64(payload)}.{_b64(_signature(payload, secret))}"
+
+
+def read_token(token: str, secret: str | None = None):
+    """
+    (cid, rid, template_key) for a genuine token, None for anything forged,
+    truncated or signed with another key.
+    """
+    secret = secret or current_app.config["SECRET_KEY"]
+    try:
+        payload_part, sig_part = token.split(".")
+        payload = _unb64(payload_part)
+        sig = _unb64(sig_part)
+    except ValueError:
+        return None
+
+    if not hmac.compare_digest(sig, _signature(payload, secret)):
+        return None
+
+    try:
+        cid, rid, template_key = payload.decode("utf-8").split(".", 2)
+        return int(cid), int(rid), template_key
+    except ValueError:
+        return None
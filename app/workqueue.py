@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+from sqlalchemy import and_, func, or_, select, update
+from .db import db
+from .models import CampaignRecipient, SendBatch, SendJob
+
+# --- DB-backed send queue --- #
+# A campaign's recipients are split into SendBatch rows (ranges of recipient
+# ids). Any number of worker threads, processes or hosts pull batches from
+# the table; a claim is a lease, so a batch held by a worker that died is
+# picked up again once the lease runs out.
+
+
+def plan_batches(job, batch_size):
+    """
+    Split the job's campaign_recipients into batches of at most batch_size
+    recipients. Reads only recipient ids, one page at a time. The caller commits.
+    """
+    now = datetime.utcnow()
+    last_id = 0
+    batches = 0
+    while True:
+        ids = db.session.scalars(
+            select(CampaignRecipient.recipient_id)
+            .where(CampaignRecipient.campaign_id == job.campaign_id, CampaignRecipient.recipient_id > last_id)
+            .order_by(CampaignRecipient.recipient_id)
+            .limit(batch_size)
+        ).all()
+        if not ids:
+            return batches
+        db.session.add(SendBatch(
+            job_id=job.id,
+            campaign_id=job.campaign_id,
+            first_recipient_id=ids[0],
+            last_recipient_id=ids[-1],
+            status="queued",
+            available_at=now,
+        ))
+        batches += 1
+        last_id = ids[-1]
+
+
+def _claimable(now, job_id=None):
+    """Batch is free (queued and due, or its lease ran out) and its job is live."""
+    cond = and_(
+        or_(
+            and_(SendBatch.status == "queued", SendBatch.available_at <= now),
+            and_(SendBatch.status == "claimed", SendBatch.lease_expires_at < now),
+        ),
+        SendBatch.job_id.in_(select(SendJob.id).where(SendJob.status.in_(("queued", "running")))),
+    )
+    if job_id is not None:
+        cond = and_(cond, SendBatch.job_id == job_id)
+    return cond
+
+
+def claim_batch(worker_id, lease_seconds, job_id=None):
+    """
+    Claim the next available batch for worker_id (optionally only from one
+    job) and return it, or None if there is nothing to do right now.
+
+    MySQL 8 / PostgreSQL: SELECT ... FOR UPDATE SKIP LOCKED, so concurrent
+    workers never wait on (or get) the same row. SQLite has no row locks: a
+    guarded UPDATE claims the row only if it is still claimable, and the
+    rowcount says whether this worker won.
+    """
+    now = datetime.utcnow()
+    claim = dict(status="claimed", claimed_by=worker_id,
+                 lease_expires_at=now + timedelta(seconds=lease_seconds))
+
+    if db.engine.dialect.name in ("mysql", "mariadb", "postgresql"):
+        batch_id = db.session.scalars(
+            select(SendBatch.id)
+            .where(_claimable(now, job_id))
+            .order_by(SendBatch.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).first()
+        if batch_id is not None:
+            db.session.execute(update(SendBatch).where(SendBatch.id == batch_id).values(**claim))
+        db.session.commit()
+    else:
+        batch_id = None
+        candidates = db.session.scalars(
+            select(SendBatch.id)
+            .where(_claimable(now, job_id))
+            .order_by(SendBatch.id)
+            .limit(5)
+        ).all()
+        for candidate in candidates:
+            won = db.session.execute(
+                update(SendBatch)
+                .where(SendBatch.id == candidate, _claimable(now, job_id))
+                .values(**claim)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            db.session.commit()
+            if won:
+                batch_id = candidate
+                break
+
+    return db.session.get(SendBatch, batch_id) if batch_id is not None else None
+
+
+def renew_lease(batch, lease_seconds):
+    """Push the batch's lease forward while a long send is still in progress."""
+    db.session.execute(
+        update(SendBatch)
+        .where(SendBatch.id == batch.id)
+        .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=lease_seconds))
+    )
+    db.session.commit()
+
+
+def next_available_at(job_id=None):
+    """When the next queued batch becomes claimable (None if nothing is queued)."""
+    query = select(func.min(SendBatch.available_at)).where(SendBatch.status == "queued")
+    if job_id is not None:
+        query = query.where(SendBatch.job_id == job_id)
+    return db.session.scalar(query)
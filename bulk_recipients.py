@@ -0,0 +1,49 @@
+import argparse
+import sys
+from app import create_app
+from app.bulk import ACTIONS, apply
+from app.db import db
+
+# Move, detach or delete many recipients at once, e.g. for a re-org:
+#   python bulk_recipients.py move --to 3 --department 1
+#   python bulk_recipients.py move --to 3 --emails-file moved.txt
+#   python bulk_recipients.py detach --ids 10 11 12
+#   python bulk_recipients.py delete --emails-file leavers.txt
+# Each selection is applied with set-based UPDATE/DELETE statements and the
+# number of recipients affected is printed. --dry-run rolls the change back.
+parser = argparse.ArgumentParser(description="Bulk recipient operations")
+parser.add_argument("action", choices=ACTIONS)
+parser.add_argument("--ids", type=int, nargs="+", default=[], help="recipient ids")
+parser.add_argument("--emails-file", help="file with one email address per line ('-' for stdin)")
+parser.add_argument("--department", type=int, help="only recipients currently in this department (alone: all of them)")
+parser.add_argument("--to", type=int, help="target department id for 'move'")
+parser.add_argument("--dry-run", action="store_true", help="report the count without changing anything")
+args = parser.parse_args()
+
+emails = []
+if args.emails_file:
+	source = sys.stdin if args.emails_file == "-" else open(args.emails_file, encoding="utf-8")
+	with source:
+		emails = [line.strip() for line in source if line.strip()]
+
+if not (args.ids or emails or args.department is not None):
+	parser.error("select recipients with --ids, --emails-file and/or --department")
+
+app = create_app()
+with app.app_context():
+	try:
+		affected = apply(
+			args.action, recipient_ids=args.ids, emails=emails,
+			department_id=args.department, to_department_id=args.to,
+			# --department on its own means everyone in it
+			all_in_department=args.department is not None and not (args.ids or emails),
+		)
+	except ValueError as e:
+		parser.error(str(e))
+
+	if args.dry_run:
+		db.session.rollback()
+		print(f"{args.action}: {affected} recipient(s) would be affected (dry run, nothing changed)")
+	else:
+		db.session.commit()
+		print(f"{args.action}: {affected} recipient(s) affected")
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables from .env file (if present)
@@ -31,6 +32,65 @@ class Config:
     GMAIL_FROM_ADDR = os.getenv("GMAIL_FROM_ADDR")
     GMAIL_FROM_NAME = os.getenv("GMAIL_FROM_NAME", "ClickSafe Alerts")
 
+    # --- Background send queue ---
+    # "thread": the web process that launched a campaign also sends it.
+    # "db": only worker.py processes (on any host) send; the web node just queues.
+    SEND_QUEUE_BACKEND = os.getenv("SEND_QUEUE_BACKEND", "thread")
+    # Number of campaign deliveries that may run at the same time in this process
+    SEND_QUEUE_WORKERS = int(os.getenv("SEND_QUEUE_WORKERS", 2))
+    # A worker that holds a batch longer than this is presumed dead (seconds)
+    SEND_BATCH_LEASE = int(os.getenv("SEND_BATCH_LEASE", 900))
+    # How often an idle worker checks the queue (seconds)
+    SEND_WORKER_POLL = float(os.getenv("SEND_WORKER_POLL", 2))
+    # Recipients streamed, sent and committed per batch
+    SEND_CHUNK_SIZE = int(os.getenv("SEND_CHUNK_SIZE", 500))
+    # Check pre-compiled email output against Jinja: "off", "sample" or "all"
+    RENDER_VERIFY = os.getenv("RENDER_VERIFY", "sample")
+    # Failed sends are retried with exponential backoff (seconds, doubling)
+    SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", 3))
+    SEND_RETRY_BACKOFF = float(os.getenv("SEND_RETRY_BACKOFF", 30))
+
+    # --- Delivery engine: per-provider parallelism and throttling ---
+    # Concurrency = simultaneous SMTP sends (keep <= SMTP_POOL_SIZE);
+    # rate limit = max messages per second, 0 means unlimited.
+    MAILTRAP_CONCURRENCY = int(os.getenv("MAILTRAP_CONCURRENCY", 4))
+    MAILTRAP_RATE_LIMIT = float(os.getenv("MAILTRAP_RATE_LIMIT", 0))
+    GMAIL_CONCURRENCY = int(os.getenv("GMAIL_CONCURRENCY", 4))
+    GMAIL_RATE_LIMIT = float(os.getenv("GMAIL_RATE_LIMIT", 0))
+
+    # --- Click/report tracking ---
+    # Buffer tracking hits in memory and write them in batches (flushed every
+    # EVENT_BUFFER_SIZE events or EVENT_BUFFER_INTERVAL seconds).
+    # Set EVENT_BUFFER_ENABLED=false to write each hit synchronously.
+    EVENT_BUFFER_ENABLED = os.getenv("EVENT_BUFFER_ENABLED", "true").lower() == "true"
+    EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", 500))
+    EVENT_BUFFER_INTERVAL = float(os.getenv("EVENT_BUFFER_INTERVAL", 1.0))
+    # Flushes a buffered event may fail before it is logged and dropped
+    EVENT_BUFFER_MAX_ATTEMPTS = int(os.getenv("EVENT_BUFFER_MAX_ATTEMPTS", 5))
+
+    # --- Recipient imports ---
+    # Uploaded CSVs are spooled here and imported on background threads;
+    # rejected-row reports are kept here too
+    IMPORT_SPOOL_DIR = os.getenv("IMPORT_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "clicksafe-imports"))
+    # Number of imports that may run at the same time in this process
+    IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", 2))
+    # Days an import's status page and rejected-rows file are kept
+    IMPORT_RETENTION_DAYS = float(os.getenv("IMPORT_RETENTION_DAYS", 7))
+
+    # --- Live updates ---
+    # How often (seconds) open progress streams re-read send job counters,
+    # to pick up sends done by worker processes
+    LIVE_PROGRESS_INTERVAL = float(os.getenv("LIVE_PROGRESS_INTERVAL", 2))
+
+    # --- Dashboard rollups ---
+    # Event counts are always kept per day; set EVENT_BUCKET_HOURLY=true to
+    # also keep hourly buckets (and offer an hourly view on the dashboard).
+    EVENT_BUCKET_HOURLY = os.getenv("EVENT_BUCKET_HOURLY", "false").lower() == "true"
+    # Seconds the dashboard's aggregates are cached (new events clear the cache sooner)
+    DASHBOARD_CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", 30))
+    # Seconds the department roster counts are cached (local changes clear it sooner)
+    ROSTER_CACHE_TTL = float(os.getenv("ROSTER_CACHE_TTL", 300))
+
     # --- Admin login ---
     ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "admin")
     ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "changeme")
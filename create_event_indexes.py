@@ -0,0 +1,21 @@
+from sqlalchemy import text
+from app import create_app
+from app.db import db
+from app.models import Event
+
+# Add the indexes declared on Event to an existing events table.
+# Duplicate (campaign, recipient, event type) rows are removed first (oldest kept),
+# otherwise the unique index can't be built.
+app = create_app()
+with app.app_context():
+	removed = db.session.execute(text(
+		"DELETE FROM events WHERE id NOT IN ("
+		" SELECT keep_id FROM (SELECT MIN(id) AS keep_id FROM events"
+		" GROUP BY campaign_id, recipient_id, event_type) AS keep)"
+	)).rowcount
+	db.session.commit()
+	print(f"Removed {removed} duplicate event row(s)")
+
+	for index in Event.__table__.indexes:
+		index.create(bind=db.engine, checkfirst=True)
+		print(f"Index ready: {index.name}")
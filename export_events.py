@@ -0,0 +1,31 @@
+import argparse
+from pathlib import Path
+from app import create_app
+from app.export import FORMATS, write_events
+
+# Export events (with campaign, recipient and department columns) to Parquet or Arrow IPC.
+# For incremental loads pass --state: the last exported event id is kept in that file
+# and the next run only exports newer events.
+parser = argparse.ArgumentParser(description="Export ClickSafe events for BI tools")
+parser.add_argument("output", help="file to write")
+parser.add_argument("--format", choices=sorted(FORMATS), default="parquet")
+parser.add_argument("--since-id", type=int, help="only events with a higher id (overrides --state)")
+parser.add_argument("--state", help="file holding the last exported event id")
+parser.add_argument("--campaign-id", type=int, help="only this campaign's events")
+parser.add_argument("--batch-size", type=int, default=50_000, help="rows per row group / record batch")
+args = parser.parse_args()
+
+since_id = args.since_id
+if since_id is None and args.state and Path(args.state).exists():
+	since_id = int(Path(args.state).read_text().strip() or 0)
+
+app = create_app()
+with app.app_context():
+	written, last_id = write_events(
+		args.output, args.format, since_id=since_id or 0,
+		batch_size=args.batch_size, campaign_id=args.campaign_id,
+	)
+	print(f"Wrote {written} event(s) to {args.output} (last event id {last_id})")
+
+if args.state:
+	Path(args.state).write_text(f"{last_id}\n")
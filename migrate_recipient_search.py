@@ -0,0 +1,59 @@
+from sqlalchemy import func, inspect, select, text, update
+from app import create_app
+from app.db import db
+from app.models import Recipient
+
+# Add the recipients search columns (email_lower, name_lower) and their
+# indexes to an existing database:
+# - add the columns if missing
+# - fill them with lower(email) / lower(name) wherever they are empty,
+#   BATCH recipients at a time so a big table isn't locked in one long UPDATE
+# - drop the old (department_id, name) index, replaced by name_lower ones
+# - create the indexes declared on Recipient
+# Safe to run more than once.
+BATCH = 5000
+
+app = create_app()
+with app.app_context():
+	table = Recipient.__table__
+	existing = {c["name"] for c in inspect(db.engine).get_columns(table.name)}
+	for column in ("email_lower", "name_lower"):
+		if column not in existing:
+			col_type = table.c[column].type.compile(dialect=db.engine.dialect)
+			db.session.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column} {col_type}"))
+			db.session.commit()
+			print(f"Added column: {column}")
+
+	filled = 0
+	last_id = 0
+	while True:
+		# Last id of the next BATCH recipients (or of whatever is left)
+		upper = db.session.scalar(
+			select(Recipient.id).where(Recipient.id > last_id).order_by(Recipient.id).offset(BATCH - 1).limit(1)
+		) or db.session.scalar(select(func.max(Recipient.id)).where(Recipient.id > last_id))
+		if upper is None:
+			break
+		in_batch = (Recipient.id > last_id, Recipient.id <= upper)
+		for target, source in (
+			(Recipient.email_lower, Recipient.email),
+			(Recipient.name_lower, Recipient.name),
+		):
+			filled += db.session.execute(
+				update(Recipient)
+				.where(*in_batch, target.is_(None), source.is_not(None))
+				.values({target: func.lower(source)})
+				.execution_options(synchronize_session=False)
+			).rowcount
+		db.session.commit()
+		last_id = upper
+	print(f"Backfilled email_lower/name_lower: {filled} value(s)")
+
+	if "ix_recipients_department_name" in {i["name"] for i in inspect(db.engine).get_indexes(table.name)}:
+		on_table = f" ON {table.name}" if db.engine.dialect.name == "mysql" else ""
+		db.session.execute(text(f"DROP INDEX ix_recipients_department_name{on_table}"))
+		db.session.commit()
+		print("Dropped index: ix_recipients_department_name")
+
+	for index in table.indexes:
+		index.create(bind=db.engine, checkfirst=True)
+		print(f"Index ready: {index.name}")
@@ -0,0 +1,58 @@
+from sqlalchemy import inspect, literal, select, text, update
+from app import create_app
+from app.db import db, insert_ignore
+from app.models import CampaignRecipient, Event
+
+# Bring campaign_recipients up to date and backfill it from events:
+# - create the table / add the delivered_at, clicked_at, reported_at and click_ip columns if missing
+# - add a row for every (campaign, recipient) pair that has events but no row yet
+# - fill in empty delivered_at / clicked_at / reported_at / click_ip from the events
+# Safe to run more than once; rows that already have a value keep it.
+app = create_app()
+with app.app_context():
+	table = CampaignRecipient.__table__
+	db.metadata.create_all(bind=db.engine, tables=[table])
+
+	existing = {c["name"] for c in inspect(db.engine).get_columns(table.name)}
+	for column in ("delivered_at", "clicked_at", "reported_at", "click_ip"):
+		if column not in existing:
+			col_type = table.c[column].type.compile(dialect=db.engine.dialect)
+			db.session.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column} {col_type}"))
+			print(f"Added column: {column}")
+	db.session.commit()
+
+	pairs = select(
+		Event.campaign_id, Event.recipient_id, literal("sent"), literal(0)
+	).distinct()
+	added = db.session.execute(
+		insert_ignore(table).from_select(["campaign_id", "recipient_id", "status", "attempts"], pairs)
+	).rowcount
+	db.session.commit()
+	print(f"Added {added} campaign_recipients row(s)")
+
+	def event_value(column, event_type):
+		"""Correlated subquery: `column` of the pair's event of this type (unique per pair)."""
+		return (
+			select(column)
+			.where(
+				Event.campaign_id == CampaignRecipient.campaign_id,
+				Event.recipient_id == CampaignRecipient.recipient_id,
+				Event.event_type == event_type,
+			)
+			.scalar_subquery()
+		)
+
+	for target, event_type, source in (
+		(CampaignRecipient.delivered_at, "delivered", Event.ts),
+		(CampaignRecipient.clicked_at, "clicked", Event.ts),
+		(CampaignRecipient.click_ip, "clicked", Event.ip),
+		(CampaignRecipient.reported_at, "reported", Event.ts),
+	):
+		filled = db.session.execute(
+			update(CampaignRecipient)
+			.where(target.is_(None), event_value(Event.id, event_type).is_not(None))
+			.values({target: event_value(source, event_type)})
+			.execution_options(synchronize_session=False)
+		).rowcount
+		db.session.commit()
+		print(f"Backfilled {target.key}: {filled} row(s)")
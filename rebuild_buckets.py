@@ -0,0 +1,23 @@
+import argparse
+from datetime import datetime
+from app import create_app
+from app.db import db
+from app.models import EventBucket
+from app.stats import bucket_start, granularities, rebuild_buckets
+
+# Re-aggregate the dashboard's event_buckets from the events table (creating the table if needed).
+# Only closed buckets are rebuilt by default: --until defaults to the start of the current day/hour.
+parser = argparse.ArgumentParser(description="Rebuild ClickSafe event bucket rollups")
+parser.add_argument("--since", help="first day to rebuild, YYYY-MM-DD (default: all history)")
+parser.add_argument("--until", help="day to stop before, YYYY-MM-DD (default: the current bucket)")
+parser.add_argument("--granularity", choices=("day", "hour"), help="default: every granularity being kept")
+args = parser.parse_args()
+
+app = create_app()
+with app.app_context():
+	db.metadata.create_all(bind=db.engine, tables=[EventBucket.__table__])
+	since = datetime.strptime(args.since, "%Y-%m-%d") if args.since else None
+	for granularity in [args.granularity] if args.granularity else granularities():
+		until = datetime.strptime(args.until, "%Y-%m-%d") if args.until else bucket_start(datetime.utcnow(), granularity)
+		written = rebuild_buckets(granularity, since, until)
+		print(f"Rebuilt {written} {granularity} bucket(s)")
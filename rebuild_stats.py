@@ -0,0 +1,14 @@
+import sys
+from app import create_app
+from app.db import db
+from app.models import CampaignStats
+from app.stats import rebuild
+
+# Recount the campaign_stats rollup from the events table (creating the table if needed).
+# Usage: python rebuild_stats.py [campaign_id ...]   (no ids = every campaign)
+app = create_app()
+with app.app_context():
+	db.metadata.create_all(bind=db.engine, tables=[CampaignStats.__table__])
+	campaign_ids = [int(x) for x in sys.argv[1:]]
+	written = rebuild(campaign_ids or None)
+	print(f"Rebuilt stats for {written} campaign(s)")
@@ -0,0 +1,8 @@
+from app import create_app
+from app.sender import resume_interrupted_jobs
+
+# Finish campaign deliveries cut short by a restart. Sent recipients are skipped.
+app = create_app()
+with app.app_context():
+	job_ids = resume_interrupted_jobs()
+	print(f"Resumed send jobs: {job_ids or 'none'}")
@@ -0,0 +1,27 @@
+import os
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import pytest
+
+from app import create_app
+from app.db import db
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app()
+    app.config.update(TESTING=True, SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'test.db'}")
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["logged_in"] = True
+    return client
@@ -0,0 +1,44 @@
+import pytest
+
+from app.db import db
+from app.models import Department, Recipient
+
+
+@pytest.fixture(autouse=True)
+def it_department(app):
+    it = Department(name="IT")
+    db.session.add(it)
+    db.session.flush()
+    for i in range(5):
+        db.session.add(Recipient(email=f"user{i}@example.com", department_id=it.id))
+    db.session.commit()
+    return it
+
+
+def _in_it():
+    return Recipient.query.filter(Recipient.department.has(name="IT")).count()
+
+
+@pytest.mark.parametrize("action", ["delete", "detach", "move"])
+def test_form_post_without_selection_changes_nothing(client, action):
+    dept_id = Department.query.filter_by(name="IT").one().id
+    response = client.post("/recipients/bulk", data={
+        "action": action, "department_id": str(dept_id), "to_department_id": str(dept_id),
+    })
+    assert response.status_code == 302
+    assert _in_it() == 5
+
+
+def test_json_post_without_selection_is_rejected(client):
+    dept_id = Department.query.filter_by(name="IT").one().id
+    response = client.post("/recipients/bulk", json={"action": "delete", "department_id": dept_id})
+    assert response.status_code == 400
+    assert _in_it() == 5
+
+
+def test_selected_recipients_are_deleted(client):
+    dept_id = Department.query.filter_by(name="IT").one().id
+    ids = [r.id for r in Recipient.query.order_by(Recipient.id).limit(2)]
+    response = client.post("/recipients/bulk", json={"action": "delete", "department_id": dept_id, "recipient_ids": ids})
+    assert response.get_json() == {"action": "delete", "affected": 2}
+    assert _in_it() == 3
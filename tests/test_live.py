@@ -0,0 +1,37 @@
+import queue
+
+from app import live
+from app.db import db
+from app.models import Campaign, SendJob
+
+
+def test_progress_snapshot_is_not_sent_twice_on_connect(app):
+    campaign = Campaign(name="Live campaign")
+    db.session.add(campaign)
+    db.session.flush()
+    job = SendJob(campaign_id=campaign.id, template_key="payroll_update", base_url="http://localhost",
+                  status="running", total=5, sent=1, failed=0)
+    db.session.add(job)
+    db.session.commit()
+
+    broker = app.extensions["live"]
+    subscription, initial = broker.subscribe(campaign.id, live.progress_dict(job))
+    try:
+        assert initial["sent"] == 1
+
+        # The watcher's next read finds the same counters: nothing is published
+        broker.progress_changed()
+        try:
+            kind, data = subscription.get(timeout=0.5)
+        except queue.Empty:
+            pass
+        else:
+            raise AssertionError(f"duplicate {kind} message: {data}")
+
+        job.sent = 2
+        db.session.commit()
+        broker.progress_changed()
+        kind, data = subscription.get(timeout=5)
+        assert (kind, data["sent"]) == ("progress", 2)
+    finally:
+        broker.unsubscribe(campaign.id, subscription)
@@ -0,0 +1,167 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import delivery, sender
+from app.db import db
+from app.models import Campaign, CampaignRecipient, Department, Recipient, SendBatch, SendJob
+from app.workqueue import claim_batch
+
+
+@pytest.fixture
+def sent(app, monkeypatch):
+    """Addresses handed to SMTP; send_prepared is replaced so nothing leaves."""
+    app.config.update(SEND_CHUNK_SIZE=3, SEND_RETRY_BACKOFF=0.01, SEND_MAX_ATTEMPTS=3)
+    monkeypatch.setattr(sender, "_renderers", {})
+    addresses = []
+    monkeypatch.setattr(delivery, "send_prepared", lambda to_addr, message: addresses.append(to_addr))
+    return addresses
+
+
+@pytest.fixture
+def departments(app):
+    it = Department(name="IT")
+    empty = Department(name="Empty")
+    db.session.add_all([it, empty])
+    db.session.flush()
+    for i in range(8):
+        db.session.add(Recipient(email=f"user{i}@example.com", department_id=it.id))
+    db.session.commit()
+    return it, empty
+
+
+def _queue(department):
+    campaign = Campaign(name="Test campaign", subject="Payroll update")
+    db.session.add(campaign)
+    db.session.flush()
+    job = sender.create_send_job(campaign, "payroll_update", "http://localhost", [department.id])
+    db.session.commit()
+    return job
+
+
+def _run_worker(app, **kwargs):
+    """run_worker on its own thread; fails the test instead of hanging if it never returns."""
+    def run():
+        with app.app_context():
+            sender.run_worker("test-worker", poll_interval=0.01, **kwargs)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "run_worker did not return"
+    db.session.expire_all()
+
+
+def test_empty_target_job_is_done_at_once(app, sent, departments):
+    _, empty = departments
+    job = _queue(empty)
+
+    assert job.total == 0
+    assert job.status == "done"
+    assert job.finished_at is not None
+    assert SendBatch.query.count() == 0
+    _run_worker(app, job_id=job.id)
+    _run_worker(app, stop_when_idle=True)
+    assert sent == []
+
+
+def test_worker_finishes_live_job_without_open_batches(app, sent, departments):
+    # e.g. queued before create_send_job finished empty jobs itself
+    _, empty = departments
+    job = _queue(empty)
+    job.status = "queued"
+    job.finished_at = None
+    db.session.commit()
+
+    _run_worker(app, job_id=job.id)
+
+    assert db.session.get(SendJob, job.id).status == "done"
+
+
+def test_multi_batch_job_is_delivered(app, sent, departments):
+    it, _ = departments
+    job = _queue(it)
+    assert SendBatch.query.filter_by(job_id=job.id).count() == 3
+
+    _run_worker(app, stop_when_idle=True)
+
+    job = db.session.get(SendJob, job.id)
+    assert (job.status, job.total, job.sent, job.failed) == ("done", 8, 8, 0)
+    assert sorted(sent) == sorted(f"user{i}@example.com" for i in range(8))
+    assert {b.status for b in SendBatch.query.filter_by(job_id=job.id)} == {"done"}
+    assert CampaignRecipient.query.filter(CampaignRecipient.delivered_at.is_(None)).count() == 0
+
+
+def test_transient_failure_is_retried(app, sent, departments, monkeypatch):
+    it, _ = departments
+    failures = {"user4@example.com": 1}
+
+    def flaky_send(to_addr, message):
+        if failures.get(to_addr):
+            failures[to_addr] -= 1
+            raise OSError("temporary SMTP failure")
+        sent.append(to_addr)
+
+    monkeypatch.setattr(delivery, "send_prepared", flaky_send)
+    job = _queue(it)
+
+    _run_worker(app, job_id=job.id)
+
+    job = db.session.get(SendJob, job.id)
+    assert (job.status, job.sent, job.failed) == ("done", 8, 0)
+    assert sent.count("user4@example.com") == 1
+    retried = CampaignRecipient.query.join(Recipient).filter(Recipient.email == "user4@example.com").one()
+    assert (retried.status, retried.attempts) == ("sent", 2)
+
+
+def test_permanent_failure_gives_up_after_max_attempts(app, sent, departments, monkeypatch):
+    it, _ = departments
+
+    def failing_send(to_addr, message):
+        if to_addr == "user0@example.com":
+            raise OSError("mailbox unavailable")
+        sent.append(to_addr)
+
+    monkeypatch.setattr(delivery, "send_prepared", failing_send)
+    job = _queue(it)
+
+    _run_worker(app, job_id=job.id)
+
+    job = db.session.get(SendJob, job.id)
+    assert (job.status, job.sent, job.failed) == ("done", 7, 1)
+    failed = CampaignRecipient.query.join(Recipient).filter(Recipient.email == "user0@example.com").one()
+    assert (failed.status, failed.attempts) == ("failed", 3)
+
+
+def test_expired_lease_is_claimed_again(app, sent, departments):
+    it, _ = departments
+    job = _queue(it)
+
+    first = claim_batch("dead-worker", lease_seconds=900, job_id=job.id)
+    assert claim_batch("other-worker", lease_seconds=900, job_id=job.id).id != first.id
+
+    # The first worker's lease runs out without the batch being finished
+    first.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    batch_ids = {b.id for b in SendBatch.query.filter_by(job_id=job.id)}
+    reclaimed = {claim_batch("new-worker", lease_seconds=900, job_id=job.id).id for _ in range(2)}
+    assert first.id in reclaimed and reclaimed <= batch_ids
+
+
+def test_resume_skips_sent_and_fails_interrupted_recipients(app, sent, departments):
+    it, _ = departments
+    job = _queue(it)
+    rows = CampaignRecipient.query.order_by(CampaignRecipient.recipient_id).all()
+    # A worker died mid-chunk: one recipient was sent, one was in flight
+    rows[0].status, rows[0].attempts, rows[0].delivered_at = "sent", 1, datetime.utcnow()
+    rows[1].status = "sending"
+    job.sent = 1
+    db.session.commit()
+
+    _run_worker(app, job_id=job.id)
+
+    job = db.session.get(SendJob, job.id)
+    assert (job.status, job.sent, job.failed) == ("done", 7, 1)
+    assert len(sent) == 6
+    assert db.session.get(CampaignRecipient, (job.campaign_id, rows[1].recipient_id)).status == "failed"
@@ -0,0 +1,15 @@
+import argparse
+from app import create_app
+from app.sender import run_worker, worker_name
+
+# Campaign delivery worker: pulls recipient batches from the send_batches
+# table and sends them. Run as many as you like, on as many hosts as you like.
+parser = argparse.ArgumentParser(description="ClickSafe send worker")
+parser.add_argument("--once", action="store_true", help="exit when the queue is empty")
+args = parser.parse_args()
+
+app = create_app()
+with app.app_context():
+	name = worker_name()
+	print(f"Send worker {name} started")
+	run_worker(name, poll_interval=app.config["SEND_WORKER_POLL"], stop_when_idle=args.once)